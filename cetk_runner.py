@@ -0,0 +1,2357 @@
+"""
+Runs cetk jobs for the Eclair plugin.
+
+This script is executed by the python interpreter that cetk is installed for.
+Jobs are read as JSON lines from stdin, {"job": <name>, "events": <path>, ...},
+where the remaining items are passed as keyword arguments to the job.
+Everything a job reports is written as JSON lines to its events file:
+
+    {"event": "progress", "value": 42.0}
+    {"event": "validation", "sheet": "...", "row": 2, "column": "...", "message": "..."}
+    {"event": "result", ...}
+    {"event": "error", "message": "...", "traceback": "..."}
+    {"event": "done", "status": 0}
+"""
+
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import pathlib
+import pickle
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+import zipfile
+from contextlib import contextmanager
+from xml.etree import ElementTree
+
+import cetk
+from eclair_shared import (
+    OVERWRITE_POLICIES,
+    PROGRESS_PATTERN,
+    RASTER_FORMATS,
+    TABLE_EXTENSIONS,
+    table_row_count,
+)
+
+settings = cetk.configure()
+
+from cetk.edb.const import SHEET_NAMES  # noqa
+from django.db import connection  # noqa
+
+# seconds to wait for jobs in other processes that write to the database
+DATABASE_TIMEOUT = 600
+
+connection.settings_dict["OPTIONS"]["timeout"] = DATABASE_TIMEOUT
+
+# patterns to find sheet, row and column in cetk validation messages
+SHEET_PATTERNS = (
+    re.compile(r"^(\w+):"),
+    re.compile(r"sheet '?(\w+)'?", re.IGNORECASE),
+    re.compile(r"(\w+) sheet"),
+)
+SOURCETYPE_SHEETS = {
+    "pointsource": "PointSource",
+    "areasource": "AreaSource",
+    "gridsource": "GridSource",
+    "roadsource": "RoadSource",
+}
+ROW_PATTERN = re.compile(r"row '?(\d+)'?")
+COLUMN_PATTERN = re.compile(r"column '([^']+)'")
+SUBSTANCE_PATTERN = re.compile(r"for '([^']+)' on row")
+
+
+class Events:
+    """Writes events of a job as JSON lines."""
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, event, **kwargs):
+        self.file.write(json.dumps({"event": event, **kwargs}, default=str) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class EventHandler(logging.Handler):
+    """Forwards progress reported in cetk log messages as events.
+
+    Error messages are collected, cetk logs them before it exits.
+    """
+
+    def __init__(self, events):
+        super().__init__(logging.DEBUG)
+        self.events = events
+        self.errors = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if record.levelno >= logging.ERROR:
+            self.errors.append(message)
+        match = PROGRESS_PATTERN.search(message)
+        if match:
+            self.events.write("progress", value=float(match.group(1)))
+
+
+def parse_validation_message(message):
+    """Split a cetk validation message in sheet, row, column and message."""
+    message = message.split("VALIDATION:", 1)[-1].strip()
+    sheet = ""
+    for pattern in SHEET_PATTERNS:
+        match = pattern.search(message)
+        if match and match.group(1) in SHEET_NAMES:
+            sheet = match.group(1)
+            break
+    else:
+        lowercase = message.lower()
+        for sourcetype, sheet_name in SOURCETYPE_SHEETS.items():
+            if sourcetype in lowercase:
+                sheet = sheet_name
+                break
+    match = ROW_PATTERN.search(message)
+    row = int(match.group(1)) if match else None
+    match = COLUMN_PATTERN.search(message)
+    if match:
+        column = match.group(1)
+    else:
+        match = SUBSTANCE_PATTERN.search(message)
+        column = f"subst:{match.group(1)}" if match else ""
+    return {"sheet": sheet, "row": row, "column": column, "message": message}
+
+
+def check_database():
+    """raise an error if the database of the job does not exist."""
+    db_path = os.environ.get("CETK_DATABASE_PATH", "unspecified")
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(
+            f"Database {db_path} does not exist, first run "
+            "'cetk create' or 'cetk migrate'"
+        )
+
+
+# rasters of more cells are rasterized in tiles in parallel processes, tiles
+# have at most RASTER_TILE_SIZE cells in each direction
+MIN_TILED_CELLS = 250000
+RASTER_TILE_SIZE = 1000
+# hourly time series of more hours are rasterized in periods in parallel processes
+MIN_PARTITIONED_HOURS = 7 * 24
+# largest block of a tile that is held in memory when tiles are stitched
+RASTER_BLOCK_BYTES = 64 * 1024 * 1024
+# written rasters are chunked in at most this many cells in x and y
+RASTER_CHUNK_CELLS = 256
+# Zarr chunks hold as many time steps as fit in this size
+ZARR_CHUNK_BYTES = 4 * 1024 * 1024
+# caches of previous jobs, in a directory of the user that only the user can
+# access, as cached sheets are unpickled
+if os.name == "nt":
+    CACHE_DIR = os.path.join(
+        os.environ.get("LOCALAPPDATA", tempfile.gettempdir()), "eclair", "cache"
+    )
+else:
+    CACHE_DIR = os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "eclair"
+    )
+# NetCDF rasters of previous jobs, by database version and raster settings
+RASTER_CACHE_DIR = os.path.join(CACHE_DIR, "rasters")
+# total size of cached rasters, the least recently used rasters are removed
+RASTER_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+# sheets read from workbooks, shared by validation and import of a workbook
+WORKBOOK_CACHE_DIR = os.path.join(CACHE_DIR, "workbooks")
+# number of cached sheets, the least recently used sheets are removed
+WORKBOOK_CACHE_SIZE = 100
+# version of cetk whose readers of workbooks and caches of sources are replaced
+# while importing, see workbook_readers and batch_caches
+CETK_VERSION = "0.0.8"
+# cetk modules that read workbooks using openpyxl.load_workbook
+WORKBOOK_READERS = (
+    "cetk.tools.cetk_command",
+    "cetk.edb.importers.source_import",
+    "cetk.edb.importers.gridsource_import",
+    "cetk.edb.importers.roadsource_import",
+)
+# text of numbers in CSV files, without leading zeros as in codes like "01"
+NUMBER_PATTERN = re.compile(r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?")
+# columns with paths to files, relative to the directory of the import file
+TABLE_PATH_COLUMNS = {"GridSource": "path", "RoadSource": "filepath"}
+# number of rows of each chunk of a sheet that is read, cached or imported at once
+IMPORT_BATCH_ROWS = 50000
+# sheets imported in batches of IMPORT_BATCH_ROWS rows, so that memory use
+# does not grow with the number of sources
+BATCHED_SHEETS = ("PointSource", "AreaSource")
+# temporary tables of the sources in the batch being imported and of the sources
+# imported before, see batch_caches
+BATCH_SOURCES_TABLE = "eclair_batch_sources"
+IMPORTED_SOURCES_TABLE = "eclair_imported_sources"
+# number of roads of a road file read and imported at once
+ROAD_BATCH_SIZE = 50000
+DIMENSION_PATTERN = re.compile(rb'<dimension ref="[A-Z]+\d+(?::[A-Z]+(\d+))?"')
+XLSX_NAMESPACES = {
+    "main": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "rel": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "pkg": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+
+
+def sheet_parts(archive):
+    """Return {sheet name: xml part} of the sheets in an xlsx archive."""
+    workbook = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+    relations = ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    targets = {
+        relation.get("Id"): relation.get("Target")
+        for relation in relations.findall("pkg:Relationship", XLSX_NAMESPACES)
+    }
+    parts = {}
+    for sheet in workbook.findall("main:sheets/main:sheet", XLSX_NAMESPACES):
+        target = targets[sheet.get(f"{{{XLSX_NAMESPACES['rel']}}}id")]
+        parts[sheet.get("name")] = target[1:] if target.startswith("/") else f"xl/{target}"
+    return parts
+
+
+def sheet_keys(filename):
+    """Return {sheet name: cache key} of the sheets in a workbook.
+
+    The key is a hash of the xml of the sheet and of the strings and styles
+    shared by all sheets, editing another sheet does not change it unless new
+    text or formats are added.
+    """
+    with zipfile.ZipFile(filename) as archive:
+        parts = set(archive.namelist())
+        shared = hashlib.sha256()
+        for part in ("xl/sharedStrings.xml", "xl/styles.xml"):
+            if part in parts:
+                shared.update(archive.read(part))
+        workbook = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+        properties = workbook.find("main:workbookPr", XLSX_NAMESPACES)
+        if properties is not None:
+            shared.update(str(properties.get("date1904")).encode())
+        keys = {}
+        for name, part in sheet_parts(archive).items():
+            key = shared.copy()
+            key.update(archive.read(part))
+            keys[name] = key.hexdigest()
+    return keys
+
+
+def sheet_row_counts(filename):
+    """Return {sheet name: number of rows below the header} of a workbook.
+
+    Read from the dimension written at the start of each sheet, without reading
+    the cells. Sheets without a dimension are left out.
+    """
+    counts = {}
+    with zipfile.ZipFile(filename) as archive:
+        for name, part in sheet_parts(archive).items():
+            with archive.open(part) as f:
+                match = DIMENSION_PATTERN.search(f.read(4096))
+            if match:
+                counts[name] = max(int(match.group(1) or 1) - 1, 0)
+    return counts
+
+
+class CachedWorksheet:
+    def __init__(self, workbook, title):
+        self.workbook = workbook
+        self.title = title
+
+    @property
+    def values(self):
+        if self.title in self.workbook.batches:
+            return iter(self.workbook.batches[self.title])
+        # streamed, cetk also reads source sheets when importing other sheets
+        return itertools.chain.from_iterable(self.workbook.chunks(self.title))
+
+
+class CachedWorkbook:
+    """Workbook read by openpyxl once, the parsed sheets are cached on disk.
+
+    Implements the part of the read-only openpyxl workbook used by cetk.
+    Sheets are cached as a sequence of pickled chunks of IMPORT_BATCH_ROWS
+    rows, so that they can be imported in batches without reading them whole.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.keys = sheet_keys(filename)
+        self.sheetnames = list(self.keys)
+        self.worksheets = [CachedWorksheet(self, title) for title in self.sheetnames]
+        self.parsed = {}
+        # rows of sheets replaced by a batch of their rows, see import_batches
+        self.batches = {}
+
+    def __getitem__(self, title):
+        if title not in self.keys:
+            raise KeyError(f"Worksheet {title} does not exist.")
+        return self.worksheets[self.sheetnames.index(title)]
+
+    def __contains__(self, title):
+        return title in self.keys
+
+    def __iter__(self):
+        return iter(self.worksheets)
+
+    def rows(self, title):
+        """Return the values of a sheet as a list of tuples."""
+        if title not in self.parsed:
+            self.parsed[title] = list(itertools.chain.from_iterable(self.chunks(title)))
+        return self.parsed[title]
+
+    def chunks(self, title):
+        """Yield the values of a sheet as lists of tuples, header first."""
+        if title in self.parsed:
+            yield self.parsed[title]
+            return
+        make_cache_dir(WORKBOOK_CACHE_DIR)
+        path = os.path.join(WORKBOOK_CACHE_DIR, f"{self.keys[title]}.pickle")
+        try:
+            f = open(path, "rb")
+        except OSError:
+            yield from self.read_chunks(title, path)
+            return
+        with f:
+            os.utime(path)
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+
+    def read_chunks(self, title, path):
+        """Yield the values of a sheet read by openpyxl, writing them to the cache."""
+        import openpyxl
+
+        # opened for each sheet, as cetk closes the workbook after importing sheets
+        workbook = openpyxl.load_workbook(
+            filename=self.filename, data_only=True, read_only=True
+        )
+        try:
+            with cache_writer(path) as write:
+                rows = workbook[title].values
+                while True:
+                    chunk = list(itertools.islice(rows, IMPORT_BATCH_ROWS))
+                    if not chunk:
+                        break
+                    write(chunk)
+                    yield chunk
+        finally:
+            workbook.close()
+
+    def row_counts(self):
+        return sheet_row_counts(self.filename)
+
+    def close(self):
+        pass
+
+
+def make_cache_dir(path):
+    """Create a directory of the cache, raising an error if other users can
+    access the cache."""
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    if os.name != "nt":
+        stat = os.stat(CACHE_DIR)
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+            raise PermissionError(
+                f"The cache directory {CACHE_DIR} must only be accessible by its "
+                "owner, remove it or restrict its permissions."
+            )
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+
+@contextmanager
+def cache_writer(path):
+    """Write chunks of rows to the workbook cache, removing the least recently
+    used sheets.
+
+    Nothing is cached if the context is left before all chunks are written.
+    """
+    make_cache_dir(WORKBOOK_CACHE_DIR)
+    # written to a temporary file first, as jobs may run in parallel
+    f = tempfile.NamedTemporaryFile(dir=WORKBOOK_CACHE_DIR, delete=False)
+    completed = False
+    try:
+        with f:
+            yield lambda chunk: pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+        completed = True
+    finally:
+        if not completed:
+            os.remove(f.name)
+    os.replace(f.name, path)
+    cached = sorted(
+        (entry.stat().st_mtime, entry.path)
+        for entry in os.scandir(WORKBOOK_CACHE_DIR)
+        if entry.name.endswith(".pickle")
+    )
+    for _, old_path in cached[:-WORKBOOK_CACHE_SIZE]:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+
+
+class TableDirectory:
+    """Directory with one CSV or Parquet file per sheet, e.g. PointSource.csv.
+
+    Implements the same part of the openpyxl workbook as CachedWorkbook. Files
+    are read in chunks of IMPORT_BATCH_ROWS rows, which are converted to rows of
+    the types openpyxl would read from a spreadsheet. Relative paths to rasters
+    and road files are relative to the directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = table_files(directory)
+        self.keys = self.files
+        self.sheetnames = list(self.files)
+        self.worksheets = [CachedWorksheet(self, title) for title in self.sheetnames]
+        self.parsed = {}
+        self.batches = {}
+
+    def __getitem__(self, title):
+        if title not in self.files:
+            raise KeyError(f"Worksheet {title} does not exist.")
+        return self.worksheets[self.sheetnames.index(title)]
+
+    def __contains__(self, title):
+        return title in self.files
+
+    def __iter__(self):
+        return iter(self.worksheets)
+
+    def rows(self, title):
+        """Return the values of a sheet as a list of tuples."""
+        if title not in self.parsed:
+            self.parsed[title] = list(itertools.chain.from_iterable(self.chunks(title)))
+        return self.parsed[title]
+
+    def chunks(self, title):
+        """Yield the values of a sheet as lists of tuples, header first."""
+        if title in self.parsed:
+            yield self.parsed[title]
+            return
+        path = self.files[title]
+        if path.endswith(".parquet"):
+            header, chunks = read_parquet_chunks(path)
+        else:
+            header, chunks = read_csv_chunks(path)
+        yield [tuple(header)]
+        path_column = TABLE_PATH_COLUMNS.get(title)
+        for chunk in chunks:
+            if path_column in chunk.columns:
+                chunk[path_column] = chunk[path_column].map(self.absolute_path)
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            yield list(chunk.itertuples(index=False, name=None))
+
+    def absolute_path(self, path):
+        if isinstance(path, str) and path and not os.path.isabs(path):
+            return os.path.join(self.directory, path)
+        return path
+
+    def row_counts(self):
+        # Parquet files are counted as empty without pyarrow, reading them fails
+        return {title: table_row_count(path) or 0 for title, path in self.files.items()}
+
+    def close(self):
+        pass
+
+
+def table_files(directory):
+    """Return {sheet name: path} of the CSV and Parquet files in a directory."""
+    files = {}
+    for name in SHEET_NAMES:
+        for extension in TABLE_EXTENSIONS:
+            path = os.path.join(directory, name + extension)
+            if os.path.isfile(path):
+                files[name] = path
+                break
+    return files
+
+
+def read_csv_chunks(path):
+    """Return the header and an iterator of DataFrame chunks of a CSV file.
+
+    The delimiter (comma, semicolon or tab) is detected from the header. Values
+    are read as text and converted to numbers where the whole value is a
+    number, as a spreadsheet would, so codes like "1.A.3" are kept as text.
+    """
+    import csv
+
+    import pandas as pd
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        header_line = f.readline()
+    try:
+        delimiter = csv.Sniffer().sniff(header_line, delimiters=",;\t").delimiter
+    except csv.Error:
+        delimiter = ","
+    header = next(csv.reader([header_line], delimiter=delimiter))
+    reader = pd.read_csv(
+        path,
+        sep=delimiter,
+        dtype=str,
+        keep_default_na=False,
+        na_values=[""],
+        encoding="utf-8-sig",
+        chunksize=IMPORT_BATCH_ROWS,
+    )
+
+    def chunks():
+        with reader:
+            for chunk in reader:
+                chunk.columns = header
+                yield chunk.apply(spreadsheet_values)
+
+    return header, chunks()
+
+
+def spreadsheet_values(column):
+    """Convert the numbers in a column of text to int or float.
+
+    Only text written the way a spreadsheet writes numbers is converted,
+    codes such as "007" or "01" are kept as text.
+    """
+    import pandas as pd
+
+    is_number = column.str.fullmatch(NUMBER_PATTERN.pattern, na=False)
+    if not is_number.any():
+        return column
+    numbers = pd.to_numeric(column.where(is_number), errors="coerce")
+    values = column.astype(object)
+    integral = is_number & ~column.str.contains(r"[.eE]", na=False)
+    values[is_number] = numbers[is_number].astype(object)
+    values[integral] = numbers[integral].astype("int64").astype(object)
+    return values
+
+
+def read_parquet_chunks(path):
+    """Return the header and an iterator of DataFrame chunks of a Parquet file."""
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("reading Parquet files requires pyarrow to be installed")
+
+    parquet = pq.ParquetFile(path)
+
+    def chunks():
+        for batch in parquet.iter_batches(batch_size=IMPORT_BATCH_ROWS):
+            yield batch.to_pandas()
+
+    return parquet.schema_arrow.names, chunks()
+
+
+def patched_attribute(module, name):
+    """Return an attribute of a module that is replaced while importing,
+    raising an error if the installed cetk lacks it."""
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise AttributeError(
+            f"{module.__name__}.{name} is missing, Eclair supports cetk "
+            f"{CETK_VERSION} but cetk {cetk.__version__} is installed"
+        ) from None
+
+
+@contextmanager
+def workbook_readers(filename, workbook):
+    """Let cetk read the sheets of filename from workbook.
+
+    cetk opens a workbook several times using openpyxl and pandas, which are
+    replaced by readers of workbook while in this context.
+    """
+    import importlib
+
+    import openpyxl
+    import pandas
+
+    path = os.path.abspath(filename)
+    read_excel = patched_attribute(pandas, "read_excel")
+
+    def load_workbook(filename, *args, **kwargs):
+        if os.path.abspath(filename) == path:
+            return workbook
+        return openpyxl.load_workbook(filename, *args, **kwargs)
+
+    def cached_read_excel(io, *args, sheet_name=0, **kwargs):
+        if (
+            isinstance(io, (str, os.PathLike))
+            and os.path.abspath(io) == path
+            and sheet_name in workbook.keys
+        ):
+            book = openpyxl.Workbook()
+            sheet = book.active
+            sheet.title = sheet_name
+            for row in workbook[sheet_name].values:
+                sheet.append(row)
+            kwargs["engine"] = "openpyxl"
+            io = book
+        return read_excel(io, *args, sheet_name=sheet_name, **kwargs)
+
+    modules = [importlib.import_module(name) for name in WORKBOOK_READERS]
+    for module in modules:
+        patched_attribute(module, "load_workbook")
+    try:
+        for module in modules:
+            module.load_workbook = load_workbook
+        pandas.read_excel = cached_read_excel
+        yield workbook
+    finally:
+        for module in modules:
+            module.load_workbook = openpyxl.load_workbook
+        pandas.read_excel = read_excel
+        workbook.close()
+
+
+@contextmanager
+def cached_workbook(filename):
+    """Let cetk read the sheets of a workbook from the workbook cache.
+
+    Yields the filename to pass to cetk and the cached workbook.
+    """
+    workbook = CachedWorkbook(filename)
+    with workbook_readers(filename, workbook):
+        yield filename, workbook
+
+
+@contextmanager
+def table_directory(directory):
+    """Let cetk read the sheets of a directory of CSV or Parquet files.
+
+    cetk checks that it imports an .xlsx file, an empty placeholder file is
+    created in a temporary directory. Yields the filename to pass to cetk and
+    the directory read as workbook.
+    """
+    with tempfile.TemporaryDirectory(prefix="eclair_tables_") as tmpdir:
+        filename = os.path.join(
+            tmpdir, os.path.basename(os.path.normpath(directory)) + ".xlsx"
+        )
+        open(filename, "wb").close()
+        workbook = TableDirectory(directory)
+        with workbook_readers(filename, workbook):
+            yield filename, workbook
+
+
+class ImportProgress:
+    """Reports progress as the number of rows imported of all sheets.
+
+    The duration of sheets imported in batches is kept, so that the plugin can
+    estimate the duration of later imports.
+    """
+
+    def __init__(self, events, total):
+        self.events = events
+        self.total = total
+        self.done = 0
+        self.timings = {}
+
+    def record(self, sheet, nr_rows, seconds):
+        self.timings[sheet] = {"rows": nr_rows, "seconds": seconds}
+
+    def advance(self, nr_rows):
+        self.done += nr_rows
+        if self.total > 0:
+            value = min(100 * self.done / self.total, 100)
+            self.events.write("progress", value=value, rows=self.done, total=self.total)
+
+
+def merge_updates(updates, new_updates):
+    """Add the created and updated counts of new_updates to updates."""
+    for model, counts in new_updates.items():
+        if isinstance(counts, dict) and isinstance(updates.get(model), dict):
+            for key, count in counts.items():
+                updates[model][key] = updates[model].get(key, 0) + count
+        else:
+            updates[model] = counts
+
+
+def shift_rows(message, nr_rows):
+    """Add nr_rows to the row numbers in a validation message."""
+    return ROW_PATTERN.sub(
+        lambda match: match.group(0).replace(
+            match.group(1), str(int(match.group(1)) + nr_rows)
+        ),
+        message,
+    )
+
+
+@contextmanager
+def batch_caches():
+    """Let cetk cache only the sources of the current batch of a sheet.
+
+    cetk caches all sources, facilities and source activities of the database
+    for each batch. Here its caches are restricted by keyed queries to the
+    facilities and source names of the batch, so that each batch takes about
+    as long. The facilities and source names of the rows imported so far are
+    kept in a temporary table of the database.
+
+    Yields a function that sets the (facility_id, source_name) of the rows of
+    the next batch, and returns the rows with a source of an earlier batch.
+    """
+    from cetk.edb.importers import source_import
+    from cetk.edb.models import AreaSourceActivity, Facility, PointSourceActivity
+
+    cache_sources = patched_attribute(source_import, "cache_sources")
+    cache_queryset = patched_attribute(source_import, "cache_queryset")
+    batch = f"temp.{BATCH_SOURCES_TABLE}"
+    imported = f"temp.{IMPORTED_SOURCES_TABLE}"
+    # sources of a row, facility_id is NULL for sources without facility
+    same_source = (
+        f"{imported}.source_name = {batch}.source_name "
+        f"AND {imported}.facility_id IS {batch}.facility_id"
+    )
+
+    def cached_sources(queryset):
+        table = queryset.model._meta.db_table
+        where = f'"{table}"."name" IN (SELECT source_name FROM {batch})'
+        return cache_sources(queryset.extra(where=[where]))
+
+    def cached_queryset(queryset, fields):
+        model = queryset.model
+        table = model._meta.db_table
+        if model is Facility and fields == "official_id":
+            where = f'"{table}"."official_id" IN (SELECT facility_id FROM {batch})'
+        elif model in (PointSourceActivity, AreaSourceActivity):
+            sources = model._meta.get_field("source").related_model._meta.db_table
+            where = (
+                f'"{table}"."source_id" IN (SELECT id FROM "{sources}" '
+                f"WHERE name IN (SELECT source_name FROM {batch}))"
+            )
+        else:
+            return cache_queryset(queryset, fields)
+        return cache_queryset(queryset.extra(where=[where]), fields)
+
+    def set_batch(keys):
+        cursor.execute(f"DELETE FROM {batch}")
+        cursor.executemany(
+            f"INSERT INTO {batch} (row_nr, facility_id, source_name) "
+            "VALUES (%s, %s, %s)",
+            [(index, *key) for index, key in enumerate(keys) if key is not None],
+        )
+        cursor.execute(
+            f"SELECT row_nr FROM {batch} WHERE EXISTS "
+            f"(SELECT 1 FROM {imported} WHERE {same_source}) ORDER BY row_nr"
+        )
+        duplicates = [row_nr for row_nr, in cursor.fetchall()]
+        cursor.execute(
+            f"INSERT INTO {imported} (facility_id, source_name) "
+            f"SELECT DISTINCT facility_id, source_name FROM {batch} WHERE NOT EXISTS "
+            f"(SELECT 1 FROM {imported} WHERE {same_source})"
+        )
+        return duplicates
+
+    cursor = connection.cursor()
+    cursor.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS {BATCH_SOURCES_TABLE} "
+        "(row_nr INTEGER, facility_id TEXT, source_name TEXT)"
+    )
+    cursor.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS {IMPORTED_SOURCES_TABLE} "
+        "(facility_id TEXT, source_name TEXT)"
+    )
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS temp.{IMPORTED_SOURCES_TABLE}_idx "
+        f"ON {IMPORTED_SOURCES_TABLE} (source_name, facility_id)"
+    )
+    source_import.cache_sources = cached_sources
+    source_import.cache_queryset = cached_queryset
+    try:
+        yield set_batch
+    finally:
+        source_import.cache_sources = cache_sources
+        source_import.cache_queryset = cache_queryset
+        cursor.execute(f"DROP TABLE IF EXISTS {batch}")
+        cursor.execute(f"DROP TABLE IF EXISTS {imported}")
+
+
+def source_keys(header, batch):
+    """Return the (facility_id, source_name) of the rows of a source sheet as
+    compared by cetk, None for rows without a source name.
+
+    Returns an empty list if the sheet lacks the columns, cetk reports that.
+    """
+    try:
+        columns = [header.index("facility_id"), header.index("source_name")]
+    except ValueError:
+        return []
+    keys = []
+    for row in batch:
+        key = tuple(
+            None if row[column] is None or str(row[column]) in ("None", "nan")
+            else str(row[column])
+            for column in columns
+        )
+        keys.append(key if key[1] is not None else None)
+    return keys
+
+
+def import_batches(editor, filename, workbook, sheet, progress, dry_run=False):
+    """import (or validate) a sheet in batches of IMPORT_BATCH_ROWS rows.
+
+    Each batch is passed to cetk as the sheet, only the batch and the chunk of
+    the sheet it is read from are kept in memory. cetk finds duplicate sources
+    within a batch, duplicates of sources in earlier batches are found here, as
+    cetk would update the source instead.
+    """
+    started = time.monotonic()
+    rows = itertools.chain.from_iterable(workbook.chunks(sheet))
+    header = next(rows, None)
+    updates, messages = {}, []
+    nr_imported = 0
+    batch = list(itertools.islice(rows, IMPORT_BATCH_ROWS)) if header else []
+    try:
+        with batch_caches() as set_batch:
+            while batch:
+                keys = source_keys(header, batch)
+                for index in set_batch(keys):
+                    facility_id, source_name = keys[index]
+                    source = f"source_name '{source_name}'"
+                    if facility_id is not None:
+                        source = f"facility_id '{facility_id}' and " + source
+                    messages.append(
+                        f"VALIDATION: Multiple rows have the same {source} in the "
+                        f"{sheet} sheet, on row {nr_imported + index + 2}"
+                    )
+                if not dry_run and messages:
+                    break
+                workbook.batches[sheet] = [header] + batch
+                batch_updates, batch_messages = editor.import_workbook(
+                    filename, sheets=[sheet], dry_run=dry_run
+                )
+                merge_updates(updates, batch_updates)
+                messages += [shift_rows(message, nr_imported) for message in batch_messages]
+                nr_imported += len(batch)
+                progress.advance(len(batch))
+                if not dry_run and any(message.strip() for message in messages):
+                    break
+                batch = list(itertools.islice(rows, IMPORT_BATCH_ROWS))
+    finally:
+        workbook.batches.pop(sheet, None)
+    progress.record(sheet, nr_imported, time.monotonic() - started)
+    return updates, messages
+
+
+class RoadFileSlice:
+    """geopandas, but read_file reads a slice of the features of a file."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __getattr__(self, name):
+        import geopandas
+
+        return getattr(geopandas, name)
+
+    def read_file(self, filename, **kwargs):
+        import geopandas
+
+        return geopandas.read_file(filename, rows=self.rows, **kwargs)
+
+
+def count_roads(roadfile):
+    """Return the number of features in the first layer of a road file."""
+    from django.contrib.gis.gdal import DataSource
+
+    return len(DataSource(str(roadfile))[0])
+
+
+def road_file(filename, workbook):
+    """Return the path of the road file of the RoadSource sheet, or None."""
+    rows = workbook.rows("RoadSource")
+    if len(rows) < 2:
+        return None
+    path = dict(zip(rows[0], rows[1])).get("filepath")
+    if not path:
+        return None
+    return os.path.join(os.path.dirname(filename), str(path))
+
+
+@contextmanager
+def road_batches(progress):
+    """Let cetk import road files in batches of ROAD_BATCH_SIZE roads.
+
+    cetk reads the whole road file before importing it in chunks, here each
+    batch is read separately. Messages repeated for each batch are reported once.
+    """
+    from cetk.edb.importers import roadsource_import
+
+    import_roads = roadsource_import.import_roads
+    gpd = roadsource_import.gpd
+
+    def import_roads_in_batches(roadfile, config, **kwargs):
+        nr_roads = count_roads(roadfile)
+        created, messages = 0, []
+        try:
+            for start in range(0, nr_roads, ROAD_BATCH_SIZE) or [0]:
+                stop = min(start + ROAD_BATCH_SIZE, nr_roads)
+                roadsource_import.gpd = RoadFileSlice(slice(start, stop))
+                updates, batch_messages = import_roads(roadfile, config, **kwargs)
+                created += updates["roads"]["created"]
+                messages += batch_messages
+                progress.advance(stop - start)
+        finally:
+            roadsource_import.gpd = gpd
+        return {"roads": {"created": created, "updated": 0}}, list(dict.fromkeys(messages))
+
+    roadsource_import.import_roads = import_roads_in_batches
+    try:
+        yield
+    finally:
+        roadsource_import.import_roads = import_roads
+
+
+def import_workbook(events, filename, sheets, dry_run=False):
+    """import (or validate) sheets of a workbook, or of a directory of CSV or
+    Parquet files with one file per sheet.
+
+    Sheets are imported in a transaction, so nothing is imported if the job is
+    terminated or the sheets are invalid, validated sheets are always rolled back.
+    Source sheets and road files are imported in batches, progress is reported
+    as the number of rows imported, the duration of batched sheets is reported
+    with the result.
+    GridSource is imported afterwards, as rasters are written by GDAL using its
+    own connection to the database. It is imported also when validating, so the
+    plugin validates GridSource on a copy of the database, where the other
+    sheets are kept for it.
+    """
+    from django.db import transaction
+
+    from cetk.tools.cetk_command import Editor
+
+    check_database()
+    editor = Editor()
+    grid_sheets = [sheet for sheet in sheets if sheet == "GridSource"]
+    batched_sheets = [sheet for sheet in sheets if sheet in BATCHED_SHEETS]
+    sheets = [
+        sheet for sheet in sheets if sheet != "GridSource" and sheet not in BATCHED_SHEETS
+    ]
+    updates, messages = {}, []
+    # progress is reported per batch instead of by cetk
+    logging.getLogger("cetk").setLevel(logging.INFO)
+    sheet_source = table_directory if os.path.isdir(filename) else cached_workbook
+    with sheet_source(filename) as (filename, workbook):
+        # cetk reads the GridSource sheet using the suffix of a Path
+        path = pathlib.Path(filename)
+        batched_sheets = [sheet for sheet in batched_sheets if sheet in workbook.keys]
+        row_counts = workbook.row_counts()
+        # the RoadSource sheet configures the road file, roads are counted instead
+        other_rows = sum(
+            row_counts.get(sheet, 0) for sheet in sheets if sheet != "RoadSource"
+        )
+        grid_rows = sum(row_counts.get(sheet, 0) for sheet in grid_sheets)
+        total = (
+            sum(row_counts.get(sheet, 0) for sheet in batched_sheets)
+            + other_rows
+            + grid_rows
+        )
+        if "RoadSource" in sheets and "RoadSource" in workbook.keys:
+            try:
+                total += count_roads(road_file(filename, workbook))
+            except Exception:
+                # cetk reports a missing or invalid road file
+                pass
+        progress = ImportProgress(events, total)
+        if sheets or batched_sheets:
+            with transaction.atomic(), road_batches(progress):
+                if sheets:
+                    updates, messages = editor.import_workbook(
+                        path, sheets=sheets, dry_run=dry_run
+                    )
+                    progress.advance(other_rows)
+                for sheet in batched_sheets:
+                    if not dry_run and any(message.strip() for message in messages):
+                        break
+                    sheet_updates, sheet_messages = import_batches(
+                        editor, path, workbook, sheet, progress, dry_run=dry_run
+                    )
+                    merge_updates(updates, sheet_updates)
+                    messages += sheet_messages
+                failed = any(message.strip() for message in messages)
+                if failed and not dry_run:
+                    transaction.set_rollback(True)
+                    grid_sheets = []
+                elif dry_run and not grid_sheets:
+                    transaction.set_rollback(True)
+        if grid_sheets:
+            grid_updates, grid_messages = editor.import_workbook(
+                path, sheets=grid_sheets, dry_run=dry_run
+            )
+            updates.update(grid_updates)
+            messages += grid_messages
+            progress.advance(grid_rows)
+    for message in messages:
+        if message.strip():
+            events.write("validation", **parse_validation_message(message))
+    events.write("result", updates=updates, timings=progress.timings)
+
+
+def rasterize(outputpath, cellsize, begin=None, end=None, substances=None, **kwargs):
+    """rasterize emissions to one NetCDF file per substance in outputpath."""
+    from cetk.edb.models import Substance
+    from cetk.tools.cetk_command import Editor
+
+    if begin is not None and end is not None:
+        begin = datetime.datetime.fromisoformat(begin).replace(tzinfo=datetime.timezone.utc)
+        end = datetime.datetime.fromisoformat(end).replace(tzinfo=datetime.timezone.utc)
+    if substances is not None:
+        substances = list(Substance.objects.filter(slug__in=substances))
+    # cetk joins the ids of sources into SQL as text
+    for key in ("point_ids", "area_ids", "grid_ids", "road_ids"):
+        if kwargs.get(key) is not None:
+            kwargs[key] = [str(source_id) for source_id in kwargs[key]]
+    Editor().rasterize_emissions(
+        outputpath, cellsize, begin=begin, end=end, substances=substances, **kwargs
+    )
+
+
+def rasterize_emissions(
+    events,
+    outputpath,
+    cellsize,
+    processes=1,
+    begin=None,
+    end=None,
+    substances=None,
+    output_format="netcdf",
+    overwrite="error",
+    **kwargs,
+):
+    """rasterize emissions to one file per substance in outputpath.
+
+    Large extents are split in tiles and long time series in periods, which
+    are rasterized in up to processes parallel processes. Rasters are written
+    in output_format, see RASTER_FORMATS. Existing files of substances raise
+    an error, are overwritten or are kept, depending on overwrite.
+    """
+    from cetk.emissions.calc import get_used_substances
+
+    check_database()
+    if output_format not in RASTER_FORMATS:
+        raise ValueError(f"Unknown raster format '{output_format}'")
+    if overwrite not in OVERWRITE_POLICIES:
+        raise ValueError(f"Unknown overwrite policy '{overwrite}'")
+    extension = RASTER_FORMATS[output_format]
+    if substances is None:
+        substances = [substance.slug for substance in get_used_substances()]
+    os.makedirs(outputpath, exist_ok=True)
+    existing = [
+        slug
+        for slug in substances
+        if os.path.exists(os.path.join(outputpath, slug + extension))
+    ]
+    if existing and overwrite == "error":
+        raise FileExistsError(
+            f"Rasters already exist in {outputpath}: "
+            + ", ".join(slug + extension for slug in existing)
+        )
+    if overwrite == "keep":
+        substances = [slug for slug in substances if slug not in existing]
+    files, nonzero = [], []
+    if substances:
+        # rasters are written next to outputpath first, existing files are
+        # only replaced when all rasters are done
+        rasters_path = tempfile.mkdtemp(prefix=".eclair_rasters_", dir=outputpath)
+        try:
+            keys = raster_cache_keys(substances, cellsize, begin, end, kwargs)
+            cached = use_cached_rasters(rasters_path, keys)
+            missing = [slug for slug in substances if slug not in cached]
+            if missing:
+                rasterize_netcdf(
+                    events,
+                    rasters_path,
+                    cellsize,
+                    processes,
+                    begin=begin,
+                    end=end,
+                    substances=missing,
+                    **kwargs,
+                )
+                cache_rasters(
+                    rasters_path,
+                    {slug: keys[slug] for slug in missing if slug in keys},
+                )
+            for filename in sorted(os.listdir(rasters_path)):
+                if not filename.endswith(".nc"):
+                    continue
+                path = os.path.join(rasters_path, filename)
+                output_name = filename[: -len(".nc")] + extension
+                if has_emissions(path):
+                    nonzero.append(output_name)
+                RASTER_WRITERS[output_format](
+                    path,
+                    os.path.join(rasters_path, output_name),
+                    cellsize,
+                    kwargs.get("extent"),
+                )
+                files.append(output_name)
+            for output_name in files:
+                output = os.path.join(outputpath, output_name)
+                if os.path.isdir(output):
+                    shutil.rmtree(output)
+                os.replace(os.path.join(rasters_path, output_name), output)
+        finally:
+            shutil.rmtree(rasters_path, ignore_errors=True)
+    events.write("result", outputpath=outputpath, files=files, nonzero=nonzero)
+
+
+def database_version():
+    """Return the version of the database of the job, which changes with
+    every write to the database."""
+    db_path = os.path.abspath(os.environ.get("CETK_DATABASE_PATH", "unspecified"))
+    version = [db_path]
+    for path in (db_path, db_path + "-wal"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            version += [stat.st_mtime_ns, stat.st_size]
+    return version
+
+
+def raster_cache_keys(substances, cellsize, begin, end, kwargs):
+    """Return {substance: key} of the cached rasters of a rasterize job.
+
+    Rasters per activity code of a codeset are not cached.
+    """
+    if kwargs.get("codeset"):
+        return {}
+    version = database_version()
+    keys = {}
+    for slug in substances:
+        settings = json.dumps(
+            {
+                "database": version,
+                "substance": slug,
+                "cellsize": cellsize,
+                "begin": begin,
+                "end": end,
+                **kwargs,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        keys[slug] = hashlib.sha256(settings.encode("utf-8")).hexdigest()
+    return keys
+
+
+def use_cached_rasters(rasters_path, keys):
+    """Copy cached rasters to rasters_path, returns the substances of the
+    copied rasters."""
+    cached = []
+    for slug, key in keys.items():
+        path = os.path.join(RASTER_CACHE_DIR, f"{key}.nc")
+        try:
+            shutil.copyfile(path, os.path.join(rasters_path, f"{slug}.nc"))
+            # most recently used
+            os.utime(path)
+        except FileNotFoundError:
+            continue
+        cached.append(slug)
+    return cached
+
+
+def cache_rasters(rasters_path, keys):
+    """Add the rasters of substances in rasters_path to the raster cache,
+    removing the least recently used rasters."""
+    make_cache_dir(RASTER_CACHE_DIR)
+    for slug, key in keys.items():
+        path = os.path.join(rasters_path, f"{slug}.nc")
+        if not os.path.exists(path):
+            continue
+        # written to a temporary file first, as jobs may run in parallel
+        f = tempfile.NamedTemporaryFile(
+            dir=RASTER_CACHE_DIR, suffix=".tmp", delete=False
+        )
+        f.close()
+        try:
+            shutil.copyfile(path, f.name)
+            os.replace(f.name, os.path.join(RASTER_CACHE_DIR, f"{key}.nc"))
+        finally:
+            if os.path.exists(f.name):
+                os.remove(f.name)
+    cached = sorted(
+        (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+        for entry in os.scandir(RASTER_CACHE_DIR)
+        if entry.name.endswith(".nc")
+    )
+    size = sum(entry_size for _, entry_size, _ in cached)
+    for _, entry_size, old_path in cached:
+        if size <= RASTER_CACHE_BYTES:
+            break
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+        size -= entry_size
+
+
+def rasterize_netcdf(
+    events, outputpath, cellsize, processes=1, begin=None, end=None, **kwargs
+):
+    """rasterize emissions to one NetCDF file per substance in outputpath."""
+    tiles, periods = [], []
+    if kwargs.get("extent") is not None and processes > 1:
+        tiles = raster_tiles(kwargs["extent"], cellsize, processes)
+        if begin is not None and end is not None:
+            periods = time_periods(begin, end, processes)
+    if len(tiles) > 1 or len(periods) > 1:
+        rasterize_parts(
+            events, outputpath, cellsize, tiles, periods, processes, begin, end, **kwargs
+        )
+    else:
+        rasterize(outputpath, cellsize, begin=begin, end=end, **kwargs)
+
+
+def raster_tiles(extent, cellsize, processes):
+    """Split a raster in tiles, returns [(column, row, nx, ny), ...] in cells.
+
+    There are at least as many tiles as processes, of at most RASTER_TILE_SIZE
+    cells in each direction. Rasters smaller than MIN_TILED_CELLS are not split.
+    """
+    x1, y1, x2, y2 = extent
+    nx = math.ceil((x2 - x1) / cellsize)
+    ny = math.ceil((y2 - y1) / cellsize)
+    if nx * ny < MIN_TILED_CELLS:
+        return [(0, 0, nx, ny)]
+    columns = math.ceil(math.sqrt(processes))
+    rows = math.ceil(processes / columns)
+    tile_nx = min(RASTER_TILE_SIZE, math.ceil(nx / columns))
+    tile_ny = min(RASTER_TILE_SIZE, math.ceil(ny / rows))
+    return [
+        (column, row, min(tile_nx, nx - column), min(tile_ny, ny - row))
+        for row in range(0, ny, tile_ny)
+        for column in range(0, nx, tile_nx)
+    ]
+
+
+def tile_extent(extent, cellsize, tile):
+    """Return the extent of a tile."""
+    x1, y1 = extent[:2]
+    column, row, nx, ny = tile
+    return (
+        x1 + column * cellsize,
+        y1 + row * cellsize,
+        x1 + (column + nx) * cellsize,
+        y1 + (row + ny) * cellsize,
+    )
+
+
+def tile_sources(
+    extent, cellsize, tiles, srid=None, sourcetypes=None, point_ids=None, area_ids=None
+):
+    """Assign each point and area source to one tile of a raster.
+
+    cetk rasterizes the points on the edges of an extent, so points on the edge
+    of two tiles would be counted twice. Points are assigned to the tile of
+    their cell instead. cetk spreads an area source over the part of it in the
+    extent, so area sources are assigned to the tile covering them. Area
+    sources crossing the edge of a tile are grouped by the tiles they span,
+    each group is rasterized on the cells covering its sources. Road and grid
+    sources are split over the tiles by cetk, by the part of them in each cell.
+
+    Returns {tile: {"point_ids": [...], "area_ids": [...]}} and
+    {(column, row, nx, ny): area_ids} of the groups of crossing area sources.
+    """
+    from cetk.edb.const import DEFAULT_SRID
+    from cetk.edb.models import AreaSource, PointSource
+    from django.contrib.gis.db.models.functions import Transform
+
+    srid = srid or DEFAULT_SRID
+    sourcetypes = sourcetypes or ("point", "area")
+    x1, y1, x2, y2 = extent
+    nx = math.ceil((x2 - x1) / cellsize)
+    ny = math.ceil((y2 - y1) / cellsize)
+    tile_nx, tile_ny = tiles[0][2:]
+    tiles_by_index = {
+        (tile[0] // tile_nx, tile[1] // tile_ny): tile for tile in tiles
+    }
+
+    def cell_of(x, y):
+        # cetk puts sources on the upper and right edge of the extent in the last cell
+        column = min(math.floor((x - x1) / cellsize), nx - 1)
+        row = min(math.floor((y - y1) / cellsize), ny - 1)
+        return column, row
+
+    def tile_of(column, row):
+        return tiles_by_index[column // tile_nx, row // tile_ny]
+
+    sources = {tile: {} for tile in tiles}
+    # {(first tile, last tile): [column1, row1, column2, row2, area_ids]}
+    groups = {}
+    if "point" in sourcetypes:
+        for tile_ids in sources.values():
+            tile_ids["point_ids"] = []
+        points = PointSource.objects.annotate(point=Transform("geom", srid))
+        if point_ids is not None:
+            points = points.filter(id__in=point_ids)
+        for source_id, point in points.values_list("id", "point").iterator():
+            if x1 <= point.x <= x2 and y1 <= point.y <= y2:
+                sources[tile_of(*cell_of(point.x, point.y))]["point_ids"].append(source_id)
+    if "area" in sourcetypes:
+        for tile_ids in sources.values():
+            tile_ids["area_ids"] = []
+        areas = AreaSource.objects.annotate(polygon=Transform("geom", srid))
+        if area_ids is not None:
+            areas = areas.filter(id__in=area_ids)
+        for source_id, polygon in areas.values_list("id", "polygon").iterator():
+            xmin, ymin, xmax, ymax = polygon.extent
+            if xmax < x1 or ymax < y1 or xmin > x2 or ymin > y2:
+                continue
+            column1, row1 = cell_of(max(xmin, x1), max(ymin, y1))
+            column2, row2 = cell_of(min(xmax, x2), min(ymax, y2))
+            first, last = tile_of(column1, row1), tile_of(column2, row2)
+            if first == last:
+                sources[first]["area_ids"].append(source_id)
+                continue
+            group = groups.setdefault(
+                (first, last), [column1, row1, column2, row2, []]
+            )
+            group[:4] = [
+                min(group[0], column1),
+                min(group[1], row1),
+                max(group[2], column2),
+                max(group[3], row2),
+            ]
+            group[4].append(source_id)
+    crossing = {
+        (column1, row1, column2 - column1 + 1, row2 - row1 + 1): ids
+        for column1, row1, column2, row2, ids in groups.values()
+    }
+    return sources, crossing
+
+
+def init_pool_process():
+    """Prepare a process of a process pool of a job.
+
+    Events are written by the job, stopping the plugin stops the whole
+    process group.
+    """
+    cetk_log = logging.getLogger("cetk")
+    for handler in list(cetk_log.handlers):
+        if isinstance(handler, EventHandler):
+            cetk_log.removeHandler(handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def run_in_pool(events, function, arguments, processes):
+    """Call function with each of arguments in a pool of processes.
+
+    Progress is reported as the part of the calls that is done.
+    """
+    import concurrent.futures
+
+    # each process opens its own connection to the database
+    connection.close()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, initializer=init_pool_process
+    ) as executor:
+        futures = [executor.submit(function, *args) for args in arguments]
+        try:
+            for nr_done, future in enumerate(
+                concurrent.futures.as_completed(futures), 1
+            ):
+                future.result()
+                events.write("progress", value=100 * nr_done / (len(futures) + 1))
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def time_periods(begin, end, processes):
+    """Split the hours from begin to end (both included) in periods.
+
+    Returns [(first hour, number of hours, begin, end), ...], where first hour
+    is the index of the first hour of the period in the whole time series.
+    Periods are calendar months, or as many periods of whole days as processes
+    if there are fewer months. Series shorter than MIN_PARTITIONED_HOURS are
+    not split.
+    """
+    hour = datetime.timedelta(hours=1)
+    begin = datetime.datetime.fromisoformat(begin)
+    end = datetime.datetime.fromisoformat(end)
+    nr_hours = int((end - begin) / hour) + 1
+    if nr_hours < MIN_PARTITIONED_HOURS:
+        return [(0, nr_hours, begin.isoformat(), end.isoformat())]
+    starts = [begin]
+    month = begin.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while True:
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+        if month > end:
+            break
+        starts.append(month)
+    if len(starts) < processes:
+        days = math.ceil(nr_hours / 24 / processes)
+        starts = [
+            begin + datetime.timedelta(days=days * nr)
+            for nr in range(processes)
+            if begin + datetime.timedelta(days=days * nr) <= end
+        ]
+    periods = []
+    for start, next_start in zip(starts, starts[1:] + [end + hour]):
+        periods.append(
+            (
+                int((start - begin) / hour),
+                int((next_start - start) / hour),
+                start.isoformat(),
+                (next_start - hour).isoformat(),
+            )
+        )
+    return periods
+
+
+def rasterize_parts(
+    events, outputpath, cellsize, tiles, periods, processes, begin, end, extent, **kwargs
+):
+    """rasterize tiles of extent, and periods from begin to end, in parallel
+    processes, and write them to one NetCDF file per substance in outputpath.
+
+    Sources are assigned to tiles by tile_sources, the area sources crossing
+    tiles are rasterized on the cells covering them and added to the tiles.
+    """
+    periods = periods or [(0, 0, begin, end)]
+    tile_kwargs, crossing = {tile: {} for tile in tiles}, {}
+    if len(tiles) > 1:
+        tile_kwargs, crossing = tile_sources(
+            extent,
+            cellsize,
+            tiles,
+            srid=kwargs.get("srid"),
+            sourcetypes=kwargs.get("sourcetypes"),
+            point_ids=kwargs.get("point_ids"),
+            area_ids=kwargs.get("area_ids"),
+        )
+    parts_path = tempfile.mkdtemp(prefix="eclair_raster_parts_")
+    try:
+        arguments, parts, overlays = [], [], []
+        for tile in tiles:
+            for first_hour, _, period_begin, period_end in periods:
+                part_path = os.path.join(parts_path, str(len(arguments)))
+                part_kwargs = dict(
+                    kwargs,
+                    **tile_kwargs[tile],
+                    extent=tile_extent(extent, cellsize, tile),
+                    begin=period_begin,
+                    end=period_end,
+                )
+                arguments.append((part_path, cellsize, part_kwargs))
+                parts.append((tile, first_hour, part_path))
+        for overlay, area_ids in crossing.items():
+            for first_hour, _, period_begin, period_end in periods:
+                part_path = os.path.join(parts_path, str(len(arguments)))
+                part_kwargs = dict(
+                    kwargs,
+                    sourcetypes=["area"],
+                    area_ids=area_ids,
+                    extent=tile_extent(extent, cellsize, overlay),
+                    begin=period_begin,
+                    end=period_end,
+                )
+                arguments.append((part_path, cellsize, part_kwargs))
+                overlays.append((overlay, first_hour, part_path))
+        run_in_pool(events, rasterize_part, arguments, processes)
+        times = None
+        if begin is not None and end is not None:
+            epoch = datetime.datetime(1970, 1, 1)
+            first = (datetime.datetime.fromisoformat(begin) - epoch).total_seconds() / 3600
+            nr_hours = sum(nr_hours for _, nr_hours, _, _ in periods)
+            times = [first + hour for hour in range(nr_hours)]
+        os.makedirs(outputpath, exist_ok=True)
+        stitch_rasters(outputpath, parts, extent, cellsize, times, overlays)
+    finally:
+        shutil.rmtree(parts_path, ignore_errors=True)
+
+
+def rasterize_part(part_path, cellsize, kwargs):
+    rasterize(part_path, cellsize, **kwargs)
+
+
+def stitch_rasters(outputpath, parts, extent, cellsize, times=None, overlays=()):
+    """Write rasters of parts to one NetCDF file per substance in outputpath.
+
+    parts are [((column, row, nx, ny), first hour, path), ...], where path has
+    the NetCDF files of a tile for the period starting at first hour of times,
+    the hours since 1970 of a time series. Cells and hours that parts have no
+    emissions of a substance for, or that are masked, are zero. overlays are
+    parts like parts, which are added to the stitched tiles. Parts are copied
+    in blocks of at most RASTER_BLOCK_BYTES.
+    """
+    import netCDF4 as nc
+    import numpy as np
+
+    nx = max(column + tile_nx for (column, _, tile_nx, _), _, _ in parts)
+    ny = max(row + tile_ny for (_, row, _, tile_ny), _, _ in parts)
+    all_parts = [(part, False) for part in parts] + [(part, True) for part in overlays]
+    filenames = sorted(
+        {
+            filename
+            for (_, _, path), _ in all_parts
+            if os.path.isdir(path)
+            for filename in os.listdir(path)
+            if filename.endswith(".nc")
+        }
+    )
+    for filename in filenames:
+        paths = [
+            os.path.join(path, filename)
+            for (_, _, path), _ in all_parts
+            if os.path.exists(os.path.join(path, filename))
+        ]
+        # the part with the most time steps describes the stitched file
+        template = max(paths, key=nr_time_steps)
+        with nc.Dataset(template) as src, nc.Dataset(
+            os.path.join(outputpath, filename), "w", format="NETCDF4"
+        ) as dst:
+            create_stitched_dataset(src, dst, extent, cellsize, nx, ny, times)
+        with nc.Dataset(os.path.join(outputpath, filename), "a") as dst:
+            fields = [
+                name
+                for name, var in dst.variables.items()
+                if var.dimensions[-2:] == ("y", "x")
+            ]
+            nr_times = len(dst.dimensions["time"]) if "time" in dst.dimensions else 0
+            # hours of each period, up to the first hour of the next one
+            first_hours = sorted({first_hour for _, first_hour, _ in parts})
+            ends = dict(zip(first_hours, first_hours[1:] + [nr_times]))
+            for ((column, row, tile_nx, tile_ny), first_hour, path), add in all_parts:
+                path = os.path.join(path, filename)
+                src = nc.Dataset(path) if os.path.exists(path) else None
+
+                def write(var, index, data):
+                    if add:
+                        data = data + np.ma.filled(var[index], 0)
+                    var[index] = data
+
+                try:
+                    for name in fields:
+                        var = dst[name]
+                        src_var = None if src is None else src.variables.get(name)
+                        cells = (slice(row, row + tile_ny), slice(column, column + tile_nx))
+                        if var.ndim == 2:
+                            # cetk may add a cell to a tile when rounding its extent
+                            data = (
+                                np.zeros((tile_ny, tile_nx), dtype=var.dtype)
+                                if src_var is None
+                                else np.ma.filled(src_var[:tile_ny, :tile_nx], 0)
+                            )
+                            write(var, cells, data)
+                            continue
+                        nr_src_times = 0 if src_var is None else len(src_var)
+                        block = max(1, RASTER_BLOCK_BYTES // (tile_nx * tile_ny * 4))
+                        for start in range(0, ends[first_hour] - first_hour, block):
+                            stop = min(start + block, ends[first_hour] - first_hour)
+                            data = np.zeros((stop - start, tile_ny, tile_nx), dtype=var.dtype)
+                            if start < nr_src_times:
+                                copied = min(stop, nr_src_times) - start
+                                data[:copied] = np.ma.filled(
+                                    src_var[start:start + copied, :tile_ny, :tile_nx], 0
+                                )
+                            hours = slice(first_hour + start, first_hour + stop)
+                            write(var, (hours, *cells), data)
+                finally:
+                    if src is not None:
+                        src.close()
+
+
+def nr_time_steps(path):
+    import netCDF4 as nc
+
+    with nc.Dataset(path) as dset:
+        return len(dset.dimensions["time"]) if "time" in dset.dimensions else 0
+
+
+def create_stitched_dataset(src, dst, extent, cellsize, nx, ny, times=None):
+    """Create the dimensions and variables of src in dst, for a raster of
+    nx * ny cells from the lower left corner of extent and the hours since
+    1970 in times, if given."""
+    import numpy as np
+
+    dst.setncatts(src.__dict__)
+    sizes = {"x": nx, "y": ny}
+    if times is not None:
+        sizes["time"] = len(times)
+    for name, dimension in src.dimensions.items():
+        size = None if dimension.isunlimited() else sizes.get(name, len(dimension))
+        dst.createDimension(name, size)
+    for name, var in src.variables.items():
+        attributes = var.__dict__
+        options = {}
+        if "_FillValue" in attributes:
+            options["fill_value"] = attributes.pop("_FillValue")
+        filters = var.filters() or {}
+        if filters.get("zlib"):
+            options["zlib"] = True
+        chunking = var.chunking()
+        if chunking != "contiguous" and var.dimensions:
+            options["chunksizes"] = [
+                min(chunk, sizes.get(dimension, chunk))
+                for chunk, dimension in zip(chunking, var.dimensions)
+            ]
+        new_var = dst.createVariable(name, var.dtype, var.dimensions, **options)
+        new_var.setncatts(attributes)
+        if name in ("x", "y"):
+            continue
+        if times is None and var.dimensions and var.dimensions[-2:] != ("y", "x"):
+            # time and time bounds
+            new_var[:] = var[:]
+    if times is not None and "time" in dst.variables:
+        dst["time"][:] = times
+        bounds = getattr(dst["time"], "bounds", None)
+        if bounds in dst.variables:
+            # cetk writes the end of each hour as its time
+            dst[bounds][:] = np.column_stack([np.asarray(times) - 1, times])
+    x1, y1 = extent[:2]
+    dst["x"][:] = x1 + (np.arange(nx) + 0.5) * cellsize
+    dst["y"][:] = y1 + (np.arange(ny) + 0.5) * cellsize
+
+
+def has_emissions(path):
+    """Return True if any emission in a NetCDF file is larger than zero.
+
+    Variables are read in blocks of time steps, see raster_blocks, reading
+    stops at the first emission.
+    """
+    import netCDF4 as nc
+    import numpy as np
+
+    with nc.Dataset(path) as dset:
+        for var in emission_variables(dset):
+            for _, data in raster_blocks(var):
+                if np.any(data > 0):
+                    return True
+    return False
+
+
+def raster_blocks(var):
+    """Yield (first time step, data) of an emission variable in blocks of at
+    most RASTER_BLOCK_BYTES, missing values are nan.
+
+    A variable without time is a single block, with first time step None.
+    """
+    import numpy as np
+
+    if var.ndim == 2:
+        yield None, np.ma.filled(var[:], np.nan)
+        return
+    ny, nx = var.shape[-2:]
+    block = max(1, RASTER_BLOCK_BYTES // (nx * ny * var.dtype.itemsize))
+    for start in range(0, var.shape[0], block):
+        yield start, np.ma.filled(var[start:start + block], np.nan)
+
+
+def raster_origin(dset, cellsize, extent=None):
+    """Return the lower left corner of the raster in dset."""
+    if extent is not None:
+        return float(extent[0]), float(extent[1])
+    # cell centres are stored in single precision
+    return (
+        float(dset["x"][0]) - cellsize / 2,
+        float(dset["y"][0]) - cellsize / 2,
+    )
+
+
+def raster_times(dset, start=0, stop=None):
+    """Return the times of dset as numpy datetimes, hours since 1970 in dset."""
+    import numpy as np
+
+    hours = np.ma.filled(dset["time"][start:stop], np.nan)
+    seconds = np.round(hours * 3600).astype("int64")
+    return np.datetime64("1970-01-01T00:00:00") + seconds.astype("timedelta64[s]")
+
+
+def emission_variables(dset):
+    return [var for name, var in dset.variables.items() if name.startswith("emission")]
+
+
+def write_geotiff(path, output, cellsize, extent=None):
+    """Write the emissions in NetCDF file path to a Cloud-Optimized GeoTIFF,
+    with one band per time step and overviews."""
+    import netCDF4 as nc
+    import numpy as np
+    import rasterio as rio
+    from rasterio.shutil import copy as rio_copy
+    from rasterio.transform import from_origin
+
+    uncompressed = output + ".tmp.tif"
+    with nc.Dataset(path) as dset:
+        (var,) = emission_variables(dset)
+        ny, nx = var.shape[-2:]
+        x1, y1 = raster_origin(dset, cellsize, extent)
+        crs = next(
+            v.crs_wkt for v in dset.variables.values() if "crs_wkt" in v.ncattrs()
+        )
+        profile = {
+            "driver": "GTiff",
+            "width": nx,
+            "height": ny,
+            "count": var.shape[0] if var.ndim == 3 else 1,
+            "dtype": "float32",
+            "crs": crs,
+            "transform": from_origin(x1, y1 + ny * cellsize, cellsize, cellsize),
+            "nodata": np.nan,
+            "bigtiff": "IF_SAFER",
+        }
+        try:
+            with rio.open(uncompressed, "w", **profile) as dst:
+                for start, data in raster_blocks(var):
+                    # rows of GeoTIFF are from north to south
+                    data = data.reshape(-1, ny, nx)[:, ::-1].astype("float32")
+                    first = 1 if start is None else start + 1
+                    dst.write(data, indexes=list(range(first, first + len(data))))
+                    if start is not None:
+                        times = raster_times(dset, start, start + len(data))
+                        for band, time_step in enumerate(times, first):
+                            dst.set_band_description(band, str(time_step))
+                dst.update_tags(
+                    **{name: str(var.getncattr(name)) for name in var.ncattrs()}
+                )
+            rio_copy(
+                uncompressed,
+                output,
+                driver="COG",
+                compress="DEFLATE",
+                predictor="YES",
+                overview_resampling="AVERAGE",
+                bigtiff="IF_SAFER",
+            )
+        finally:
+            if os.path.exists(uncompressed):
+                os.remove(uncompressed)
+
+
+def raster_chunks(var, max_bytes=0):
+    """Return the chunks of an emission variable, of at most
+    RASTER_CHUNK_CELLS cells in x and y and as many time steps as fit in
+    max_bytes, at least one."""
+    ny, nx = var.shape[-2:]
+    chunks = (
+        max(1, min(ny, RASTER_CHUNK_CELLS)),
+        max(1, min(nx, RASTER_CHUNK_CELLS)),
+    )
+    if var.ndim == 2:
+        return chunks
+    steps = max_bytes // (chunks[0] * chunks[1] * var.dtype.itemsize)
+    return (max(1, min(var.shape[0], steps)),) + chunks
+
+
+def write_netcdf(path, output, cellsize, extent=None):
+    """Write the variables in NetCDF file path to a compressed NetCDF file,
+    with emission variables chunked per time step.
+
+    The output may be path itself, it is written to a temporary file first.
+    """
+    import netCDF4 as nc
+
+    rechunked = output + ".tmp"
+    try:
+        with nc.Dataset(path) as src, nc.Dataset(
+            rechunked, "w", format="NETCDF4"
+        ) as dst:
+            dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+            for name, dimension in src.dimensions.items():
+                dst.createDimension(
+                    name, None if dimension.isunlimited() else len(dimension)
+                )
+            for name, var in src.variables.items():
+                attributes = {attr: var.getncattr(attr) for attr in var.ncattrs()}
+                raster = var.dimensions[-2:] == ("y", "x")
+                options = {}
+                if raster:
+                    options = {"zlib": True, "chunksizes": raster_chunks(var)}
+                dst_var = dst.createVariable(
+                    name,
+                    var.dtype,
+                    var.dimensions,
+                    fill_value=attributes.pop("_FillValue", None),
+                    **options,
+                )
+                dst_var.setncatts(attributes)
+                if not var.dimensions:
+                    continue
+                if not raster or var.ndim == 2:
+                    dst_var[...] = var[...]
+                    continue
+                # copied in blocks, keeping masked values masked
+                ny, nx = var.shape[-2:]
+                block = max(1, RASTER_BLOCK_BYTES // (nx * ny * var.dtype.itemsize))
+                for start in range(0, var.shape[0], block):
+                    # bounded, as writing extends an unlimited time
+                    stop = min(start + block, var.shape[0])
+                    dst_var[start:stop] = var[start:stop]
+        os.replace(rechunked, output)
+    finally:
+        if os.path.exists(rechunked):
+            os.remove(rechunked)
+
+
+def write_zarr(path, output, cellsize, extent=None):
+    """Write the variables in NetCDF file path to a Zarr store, emission
+    variables are chunked in blocks of whole time steps of about
+    ZARR_CHUNK_BYTES."""
+    import netCDF4 as nc
+    import numpy as np
+    import zarr
+
+    def attribute(value):
+        return value.tolist() if hasattr(value, "tolist") else value
+
+    with nc.Dataset(path) as dset:
+        group = zarr.open_group(output, mode="w")
+        group.attrs.update(
+            {name: attribute(dset.getncattr(name)) for name in dset.ncattrs()}
+        )
+        for name, var in dset.variables.items():
+            if var.dimensions[-2:] == ("y", "x"):
+                chunks = raster_chunks(var, ZARR_CHUNK_BYTES)
+            else:
+                chunks = var.shape
+            floating = np.issubdtype(var.dtype, np.floating)
+            array = group.create_dataset(
+                name,
+                shape=var.shape,
+                chunks=tuple(max(1, chunk) for chunk in chunks) or None,
+                dtype=var.dtype,
+                fill_value=np.nan if floating else None,
+            )
+            attributes = {
+                attr: attribute(var.getncattr(attr))
+                for attr in var.ncattrs()
+                if attr != "_FillValue"
+            }
+            # dimension names as read by xarray
+            attributes["_ARRAY_DIMENSIONS"] = list(var.dimensions)
+            array.attrs.update(attributes)
+            if var.dimensions[-2:] == ("y", "x"):
+                for start, data in raster_blocks(var):
+                    if start is None:
+                        array[...] = data
+                    else:
+                        array[start:start + len(data)] = data
+            elif var.dimensions:
+                array[...] = np.ma.filled(var[:], np.nan if floating else 0)
+
+
+def write_coo(path, output, cellsize, extent=None):
+    """Write the cells with emissions in NetCDF file path to a compressed csv
+    table, with the time (of hourly rasters), cell centre and emission of a
+    cell on each row."""
+    import csv
+    import gzip
+
+    import netCDF4 as nc
+    import numpy as np
+
+    with nc.Dataset(path) as dset, gzip.open(output, "wt", newline="") as f:
+        (var,) = emission_variables(dset)
+        ny, nx = var.shape[-2:]
+        x1, y1 = raster_origin(dset, cellsize, extent)
+        x = x1 + (np.arange(nx) + 0.5) * cellsize
+        y = y1 + (np.arange(ny) + 0.5) * cellsize
+        column = var.name
+        if "units" in var.ncattrs():
+            column += f" [{var.units}]"
+        writer = csv.writer(f)
+        writer.writerow((["time"] if var.ndim == 3 else []) + ["x", "y", column])
+        for start, data in raster_blocks(var):
+            data = data.reshape(-1, ny, nx)
+            steps, rows, columns = np.nonzero(np.nan_to_num(data) != 0)
+            cells = [x[columns], y[rows], data[steps, rows, columns]]
+            if start is not None:
+                times = raster_times(dset, start, start + len(data))
+                cells.insert(0, np.datetime_as_string(times[steps]))
+            writer.writerows(zip(*cells))
+
+
+# writers of rasters in other formats than NetCDF, see RASTER_FORMATS
+RASTER_WRITERS = {
+    "netcdf": write_netcdf,
+    "geotiff": write_geotiff,
+    "zarr": write_zarr,
+    "coo": write_coo,
+}
+
+
+def export_data(events, filename):
+    """export all data to a workbook."""
+    from cetk.tools.cetk_command import Editor
+
+    check_database()
+    Editor().export_data(filename)
+    events.write("result", filename=filename)
+
+
+def aggregate_emissions(events, filename, codeset=None):
+    """write emissions aggregated by activity code of codeset to a workbook."""
+    from cetk.tools.cetk_command import Editor
+
+    check_database()
+    Editor().aggregate_emissions(filename, codeset=codeset)
+    events.write("result", filename=filename)
+
+
+def get_settings(events):
+    """report the settings of the database."""
+    from django.forms.models import model_to_dict
+
+    from cetk.edb.models import Settings
+
+    check_database()
+    events.write("result", settings=model_to_dict(Settings.get_current()))
+
+
+# source tables with a geometry column and its spatial index
+SOURCE_GEOMETRY_TABLES = ("edb_pointsource", "edb_areasource", "edb_roadsource")
+# points along each side of a bounding box that is transformed to another srid
+EXTENT_SIDE_POINTS = 32
+
+
+def source_extent(events, srid):
+    """report the extent in srid covering all sources in the database.
+
+    Extents of point, area and road sources are read from their spatial
+    index, extents of grid sources from the extents of their rasters.
+    """
+    from django.contrib.gis.gdal import OGRGeometry
+    from django.db import OperationalError
+
+    from cetk.edb.const import WGS84_SRID
+    from cetk.edb.models import GridSourceActivity, GridSourceSubstance
+    from cetk.edb.models.gridsource_models import raster_table
+
+    check_database()
+    cursor = connection.cursor()
+    bounding_boxes = []
+    for table in SOURCE_GEOMETRY_TABLES:
+        try:
+            cursor.execute(
+                f"SELECT min(xmin), min(ymin), max(xmax), max(ymax) FROM idx_{table}_geom"
+            )
+        except OperationalError:
+            # no spatial index
+            cursor.execute(
+                "SELECT min(MbrMinX(geom)), min(MbrMinY(geom)), max(MbrMaxX(geom)),"
+                f" max(MbrMaxY(geom)) FROM {table}"
+            )
+        bbox = cursor.fetchone()
+        if bbox[0] is not None:
+            bounding_boxes.append((bbox, WGS84_SRID))
+    rasters = {
+        raster_table(name)
+        for model in (GridSourceSubstance, GridSourceActivity)
+        for name in model.objects.values_list("raster", flat=True).distinct()
+    }
+    for table in sorted(rasters):
+        # the bounds in gpkg_contents are optional, those of the tiles are not
+        cursor.execute(
+            "SELECT coalesce(contents.min_x, matrix_set.min_x),"
+            " coalesce(contents.min_y, matrix_set.min_y),"
+            " coalesce(contents.max_x, matrix_set.max_x),"
+            " coalesce(contents.max_y, matrix_set.max_y),"
+            " srs.organization, srs.organization_coordsys_id, srs.definition"
+            " FROM gpkg_contents AS contents"
+            " LEFT JOIN gpkg_tile_matrix_set AS matrix_set"
+            " ON matrix_set.table_name = contents.table_name"
+            " LEFT JOIN gpkg_spatial_ref_sys AS srs ON srs.srs_id = contents.srs_id"
+            " WHERE contents.table_name = %s",
+            [table],
+        )
+        row = cursor.fetchone()
+        if row is None or None in row[:4]:
+            continue
+        organization, coordsys_id, definition = row[4:]
+        if str(organization).upper() == "EPSG":
+            bounding_boxes.append((row[:4], int(coordsys_id)))
+        elif definition and definition != "undefined":
+            bounding_boxes.append((row[:4], definition))
+    extent = None
+    for (x1, y1, x2, y2), bbox_srid in bounding_boxes:
+        # the sides of a transformed bounding box may be curved
+        side = [nr / EXTENT_SIDE_POINTS for nr in range(EXTENT_SIDE_POINTS)]
+        ring = (
+            [(x1 + f * (x2 - x1), y1) for f in side]
+            + [(x2, y1 + f * (y2 - y1)) for f in side]
+            + [(x2 - f * (x2 - x1), y2) for f in side]
+            + [(x1, y2 - f * (y2 - y1)) for f in side]
+            + [(x1, y1)]
+        )
+        wkt = "POLYGON((" + ",".join(f"{x} {y}" for x, y in ring) + "))"
+        # an EPSG code, or the WKT of a coordinate system without one
+        polygon = OGRGeometry(wkt, srs=bbox_srid)
+        polygon.transform(int(srid))
+        bbox = polygon.extent
+        if extent is None:
+            extent = list(bbox)
+        else:
+            extent = [
+                min(extent[0], bbox[0]),
+                min(extent[1], bbox[1]),
+                max(extent[2], bbox[2]),
+                max(extent[3], bbox[3]),
+            ]
+    events.write("result", extent=extent)
+
+
+# changes to sources since the emission tables were last updated, triggers add
+# the source_id of changed sources, NULL if all sources of a type may have changed
+CHANGES_TABLE = "eclair_emission_changes"
+
+# tables with rows of a single source, by sourcetype
+SOURCE_TABLES = {
+    "point": {
+        "edb_pointsource": "id",
+        "edb_pointsourcesubstance": "source_id",
+        "edb_pointsourceactivity": "source_id",
+    },
+    "area": {
+        "edb_areasource": "id",
+        "edb_areasourcesubstance": "source_id",
+        "edb_areasourceactivity": "source_id",
+    },
+    "road": {
+        "edb_roadsource": "id",
+    },
+}
+
+# tables that the emissions of all sources of a type depend on
+SHARED_TABLES = {
+    "point": ("edb_activity", "edb_emissionfactor"),
+    "area": ("edb_activity", "edb_emissionfactor"),
+    "road": (
+        "edb_congestionprofile",
+        "edb_fleet",
+        "edb_fleetmember",
+        "edb_fleetmemberfuel",
+        "edb_flowtimevar",
+        "edb_roadclass",
+        "edb_trafficsituation",
+        "edb_vehicle",
+        "edb_vehicleef",
+        "edb_vehiclefuelcomb",
+    ),
+}
+
+# above this number of changed sources the emission table is re-created
+MAX_INCREMENTAL_SOURCES = 10000
+
+
+def change_triggers():
+    """Return {name: sql} of the triggers that record changes to sources."""
+    triggers = {}
+    for sourcetype in SOURCE_TABLES:
+        for operation, rows in (
+            ("insert", ("NEW",)),
+            ("update", ("OLD", "NEW")),
+            ("delete", ("OLD",)),
+        ):
+            for table, column in SOURCE_TABLES[sourcetype].items():
+                values = ", ".join(f"('{sourcetype}', {row}.{column})" for row in rows)
+                # a replaced row gets a new rowid, see update_emission_table
+                statement = f"INSERT OR REPLACE INTO {CHANGES_TABLE} VALUES {values};"
+                name = f"eclair_{sourcetype}_{table}_{operation}"
+                triggers[name] = (
+                    f"CREATE TRIGGER {name} AFTER {operation.upper()} ON {table} "
+                    f"BEGIN {statement} END"
+                )
+            # NULL is not unique in the primary key, replace it explicitly
+            statement = (
+                f"DELETE FROM {CHANGES_TABLE} "
+                f"WHERE sourcetype = '{sourcetype}' AND source_id IS NULL; "
+                f"INSERT INTO {CHANGES_TABLE} VALUES ('{sourcetype}', NULL);"
+            )
+            for table in SHARED_TABLES[sourcetype]:
+                name = f"eclair_{sourcetype}_{table}_{operation}"
+                triggers[name] = (
+                    f"CREATE TRIGGER {name} AFTER {operation.upper()} ON {table} "
+                    f"BEGIN {statement} END"
+                )
+    return triggers
+
+
+def check_change_tables(cursor):
+    """Raise an error if tables or columns that the change triggers use are
+    missing, e.g. after an upgrade of cetk.
+
+    Existing triggers are dropped first, a trigger on a changed table would make
+    every write to the table fail.
+    """
+    required = {}
+    for sourcetype in SOURCE_TABLES:
+        for table, column in SOURCE_TABLES[sourcetype].items():
+            required.setdefault(table, set()).add(column)
+        for table in SHARED_TABLES[sourcetype]:
+            required.setdefault(table, set())
+    missing = []
+    for table, columns in required.items():
+        cursor.execute(f"PRAGMA main.table_info({table})")
+        existing = {row[1] for row in cursor.fetchall()}
+        if not existing:
+            missing.append(table)
+        else:
+            missing += [f"{table}.{column}" for column in sorted(columns - existing)]
+    if not missing:
+        return
+    for name in change_triggers():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    raise ValueError(
+        "Changes to sources cannot be tracked, the database has no "
+        + ", ".join(missing)
+        + ". Is the version of cetk supported by Eclair?"
+    )
+
+
+def track_changes(cursor):
+    """Create the table and triggers recording changes to sources.
+
+    Returns False if changes were not tracked before, the emission tables
+    then have to be re-created.
+    """
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {CHANGES_TABLE} ("
+        "sourcetype TEXT NOT NULL, source_id INTEGER, "
+        "PRIMARY KEY (sourcetype, source_id))"
+    )
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'eclair_%'"
+    )
+    existing = {row[0] for row in cursor.fetchall()}
+    tracked = True
+    for name, sql in change_triggers().items():
+        if name not in existing:
+            cursor.execute(sql)
+            tracked = False
+    return tracked
+
+
+def update_emission_table(sourcetype, substances):
+    """Recompute emissions of changed sources in the emission table of sourcetype.
+
+    Emissions are calculated into a temporary table first, so the emission
+    table can still be read while they are calculated. In SQLite's default
+    rollback journal mode the query holds a shared lock on the database: other
+    processes can read, but cannot commit writes until it is done, they wait
+    for at most DATABASE_TIMEOUT seconds. Copying the result takes the write
+    lock.
+    Returns the number of recomputed sources, or None if the table was re-created.
+    """
+    from django.db import transaction
+
+    from cetk.edb.const import DEFAULT_EMISSION_UNIT
+    from cetk.edb.models import Settings, Substance
+    from cetk.edb.units import emis_conversion_factor_from_si
+    from cetk.emissions.queries import create_source_emis_query
+
+    table = f"{sourcetype}source_emissions"
+    columns = [s.slug for s in substances]
+    if sourcetype == "road":
+        columns.append("traffic_work")
+    cursor = connection.cursor()
+    cursor.execute(f"PRAGMA main.table_info({table})")
+    existing_columns = [row[1] for row in cursor.fetchall()]
+    # changes after this point are kept for the next update, since triggers
+    # replace rows, a source changed again gets a larger rowid
+    cursor.execute(
+        f"SELECT max(rowid) FROM {CHANGES_TABLE} WHERE sourcetype = %s", [sourcetype]
+    )
+    last_change = cursor.fetchone()[0] or 0
+    cursor.execute(
+        f"SELECT source_id FROM {CHANGES_TABLE} WHERE sourcetype = %s AND rowid <= %s",
+        [sourcetype, last_change],
+    )
+    changed = [row[0] for row in cursor.fetchall()]
+    recreate = (
+        existing_columns != ["source_id", *columns]
+        or None in changed
+        or len(changed) > MAX_INCREMENTAL_SOURCES
+    )
+    if not recreate and not changed:
+        return 0
+
+    ids = None if recreate else [str(source_id) for source_id in changed]
+    sql = create_source_emis_query(
+        sourcetype=sourcetype,
+        srid=Settings.get_current().srid,
+        ids=ids,
+        substances=substances,
+    )
+    fac = emis_conversion_factor_from_si(DEFAULT_EMISSION_UNIT)
+    substance_ids = {s.slug: s.id for s in substances}
+    if sourcetype == "road":
+        substance_ids["traffic_work"] = Substance.objects.get(slug="traffic_work").id
+    # same columns as the emission table created by cetk
+    source_subst_cols = ", ".join(
+        f'cast(sum(rec.emis*{fac if slug != "traffic_work" else 1.0}) '
+        f'FILTER (WHERE rec.substance_id={substance_ids[slug]}) as real) AS "{slug}"'
+        for slug in columns
+    )
+    new_table = f"new_{table}"
+    cursor.execute(f"DROP TABLE IF EXISTS temp.{new_table}")
+    cursor.execute(
+        f"CREATE TEMP TABLE {new_table} AS "
+        f"SELECT source_id, {source_subst_cols} FROM ({sql}) AS rec GROUP BY source_id"
+    )
+    with transaction.atomic():
+        cursor = connection.cursor()
+        if recreate:
+            cursor.execute(f"DROP TABLE IF EXISTS main.{table}")
+            cursor.execute(f"CREATE TABLE main.{table} AS SELECT * FROM temp.{new_table}")
+            cursor.execute(
+                f"CREATE INDEX main.{sourcetype}source_emis_idx ON {table} (source_id)"
+            )
+        else:
+            cursor.execute(
+                f"DELETE FROM main.{table} WHERE source_id IN ({', '.join(ids)})"
+            )
+            cursor.execute(f"INSERT INTO main.{table} SELECT * FROM temp.{new_table}")
+        cursor.execute(
+            f"DELETE FROM {CHANGES_TABLE} WHERE sourcetype = %s AND rowid <= %s",
+            [sourcetype, last_change],
+        )
+    cursor.execute(f"DROP TABLE temp.{new_table}")
+    return None if recreate else len(changed)
+
+
+def create_emission_view(cursor, sourcetype):
+    """Create the view joining sources of sourcetype with their emissions,
+    which the plugin loads as a static layer. Returns the name of the view."""
+    view = f"eclair_{sourcetype}source_emissions"
+    if sourcetype in ("point", "area"):
+        codeset_columns = "".join(
+            f", ac{i}.code AS codeset{i}_code, ac{i}.label AS codeset{i}_label"
+            for i in (1, 2, 3)
+        )
+        codeset_joins = "".join(
+            f" LEFT JOIN edb_activitycode AS ac{i}"
+            f" ON ac{i}.id = source.activitycode{i}_id"
+            for i in (1, 2, 3)
+        )
+    else:
+        codeset_columns = ""
+        codeset_joins = ""
+    # columns of source.* and emis.* are expanded each time the view is used,
+    # so the view stays valid when the emission table is re-created
+    cursor.execute(
+        f"CREATE VIEW IF NOT EXISTS {view} AS "
+        f"SELECT source.*, emis.*{codeset_columns} "
+        f"FROM edb_{sourcetype}source AS source "
+        f"LEFT JOIN {sourcetype}source_emissions AS emis ON emis.source_id = source.id"
+        f"{codeset_joins}"
+    )
+    return view
+
+
+def update_emission_tables(events, sourcetypes=None):
+    """update emission tables, only emissions of changed sources are recomputed."""
+    from django.db import transaction
+
+    from cetk.emissions.calc import get_used_substances
+
+    check_database()
+    if isinstance(sourcetypes, str):
+        sourcetypes = [sourcetypes]
+    sourcetypes = sourcetypes or ["point", "area", "road"]
+    substances = get_used_substances()
+    if len(substances) == 0:
+        raise ValueError("No emission factors or direct emissions found in database")
+    check_change_tables(connection.cursor())
+    with transaction.atomic():
+        cursor = connection.cursor()
+        if not track_changes(cursor):
+            # changes made before tracking started are unknown
+            cursor.execute(f"DELETE FROM {CHANGES_TABLE}")
+            for sourcetype in SOURCE_TABLES:
+                cursor.execute(
+                    f"INSERT INTO {CHANGES_TABLE} VALUES (%s, NULL)", [sourcetype]
+                )
+    updated = {}
+    for sourcetype in sourcetypes:
+        updated[sourcetype] = update_emission_table(sourcetype, substances)
+    views = {}
+    with transaction.atomic():
+        cursor = connection.cursor()
+        for sourcetype in sourcetypes:
+            views[sourcetype] = create_emission_view(cursor, sourcetype)
+    events.write("result", updated=updated, views=views)
+
+
+JOBS = {
+    "import": import_workbook,
+    "rasterize": rasterize_emissions,
+    "update_emission_tables": update_emission_tables,
+    "export": export_data,
+    "aggregate": aggregate_emissions,
+    "settings": get_settings,
+    "source_extent": source_extent,
+}
+
+
+def run_job(job):
+    """run a single job, returns 0 on success, 1 on failure."""
+    kwargs = dict(job)
+    name = kwargs.pop("job")
+    events = Events(kwargs.pop("events"))
+    cetk_log = logging.getLogger("cetk")
+    level = cetk_log.level
+    # console handlers keep their level, debug messages are only used for progress
+    for handler in cetk_log.handlers:
+        if handler.level == logging.NOTSET:
+            handler.setLevel(level)
+    handler = EventHandler(events)
+    cetk_log.addHandler(handler)
+    cetk_log.setLevel(logging.DEBUG)
+    status = 0
+    try:
+        JOBS[name](events, **kwargs)
+    except SystemExit as err:
+        # cetk logs an error and exits when it cannot complete a command
+        message = os.linesep.join(handler.errors) or f"cetk exited with status {err.code}"
+        events.write("error", message=message, traceback=traceback.format_exc())
+        status = 1
+    except Exception as err:
+        events.write("error", message=str(err), traceback=traceback.format_exc())
+        status = 1
+    finally:
+        cetk_log.removeHandler(handler)
+        cetk_log.setLevel(level)
+        # cetk keeps no rows of the database between commands, but a worker
+        # process would keep the connection, with its temporary tables
+        connection.close()
+    events.write("done", status=status)
+    events.close()
+    return status
+
+
+class Terminated(BaseException):
+    """Raised when the plugin stops the process, open transactions are rolled back.
+
+    Not an Exception, so that jobs and cetk do not catch it.
+    """
+
+
+def terminate(signum, frame):
+    raise Terminated(signum)
+
+
+def main():
+    """run jobs until stdin is closed.
+
+    The plugin may keep stdin open to use this process for jobs it sends later.
+    """
+    signal.signal(signal.SIGTERM, terminate)
+    if os.name == "nt":
+        signal.signal(signal.SIGBREAK, terminate)
+    status = 0
+    try:
+        for line in iter(sys.stdin.readline, ""):
+            if line.strip():
+                status = max(status, run_job(json.loads(line)))
+    except Terminated as err:
+        return 128 + err.args[0]
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
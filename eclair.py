@@ -24,8 +24,9 @@
 
 from PyQt5.QtWidgets import QApplication, QAction, QWidget, QDockWidget, QTableWidget, QTableWidgetItem
 from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QMessageBox, QComboBox
-from PyQt5.QtWidgets import QFileDialog, QCheckBox, QRadioButton, QButtonGroup, QTabWidget, QMainWindow, QLineEdit
-from PyQt5.QtCore import pyqtSlot
+from PyQt5.QtWidgets import QFileDialog, QCheckBox, QRadioButton, QButtonGroup, QTabWidget, QMainWindow, QLineEdit, QSpinBox
+from PyQt5.QtWidgets import QTableView, QHeaderView
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, QAbstractTableModel, QModelIndex, QSortFilterProxyModel, QObject
 
 from PyQt5.QtCore import QUrl
 from PyQt5.QtGui import QDesktopServices, QFont, QFontDatabase, QDoubleValidator
@@ -42,32 +43,46 @@ from qgis.core import (
     QgsVectorLayerJoinInfo,
     QgsMessageLog,
     QgsLayerTreeLayer,
-    Qgis, QgsApplication, QgsTask,
-    QgsSingleBandGrayRenderer,
-    QgsRasterBandStats
+    Qgis, QgsApplication, QgsTask, QgsSettings,
+    QgsSingleBandGrayRenderer
 )
 from qgis.gui import QgsProjectionSelectionDialog
 import time
 
+# plugin load time is logged when the plugin is loaded, see Eclair.initGui
+LOAD_STARTED = time.perf_counter()
+
 import os
-import glob
 import sys
 import subprocess
+from subprocess import CalledProcessError
+import importlib.util
+import shutil
+import shlex
+import signal
 import site
+import threading
 from math import ceil, floor
 import ast
 import re
 from pathlib import Path
+from contextlib import contextmanager
 import datetime
 import json
-from tempfile import NamedTemporaryFile, gettempdir
-from osgeo import gdal
+import csv
+from array import array
+from tempfile import NamedTemporaryFile, gettempdir, mkdtemp
+from functools import lru_cache
 
 import sqlite3
-import rasterio
 
-import processing
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from .eclair_shared import (
+    OVERWRITE_POLICIES,
+    PROGRESS_PATTERN,
+    RASTER_FORMATS,
+    TABLE_EXTENSIONS,
+    table_row_count,
+)
 
 if os.name != "nt":
     CETK_BINPATH = os.path.expanduser("~/.local/bin")
@@ -82,45 +97,20 @@ else:
     os.environ['PATH'] = OSGEO4W + r"\bin;" + os.environ['PATH']
 
 
-try: 
-    from cetk.edb.const import SHEET_NAMES
-except:
-    if QMessageBox.question(None, "Eclair dependencies not installed",
-              "Do you want to install missing python modules? \r\n"
-              "QGIS will be non-responsive for a while.",
-               QMessageBox.Ok | QMessageBox.Cancel) == QMessageBox.Ok:
-        try:
-            subprocess.check_call(["python", "-m", "pip", "install","cetk"])
-            from cetk.edb.const import SHEET_NAMES
-            QMessageBox.information(None, "Packages successfully installed",
-                                    "To make all parts of the plugin work it is recommended to restart your QGIS-session.")
-        except Exception as e:
-            error = e.stderr.decode("utf-8")    
-            QgsMessageLog.logMessage(error, level=Qgis.Warning)
-            QMessageBox.information(None, "An error occurred",
-                                    "Eclair couldn't install Python packages!\n"
-                                    "See 'General' tab in 'Log Messages' panel for details.\n")
-    else:
-        QMessageBox.information(None,
-                                "Information", "Packages not installed. Eclair will not function unless cetk is installed manually, see https://github.com/foclair/cetk for installation instructions.")
+# cetk (and django) are imported when first used, not when QGIS loads the plugin
 
+def cetk_installed():
+    """Return True if cetk can be imported, without importing it."""
+    return importlib.util.find_spec("cetk") is not None
 
 
+@lru_cache(maxsize=None)
+def sheet_names():
+    """Names of the sheets cetk imports, in the order they are imported."""
+    from cetk.edb.const import SHEET_NAMES
+    return SHEET_NAMES
+
 
-from cetk.tools.utils import (
-    CalledProcessError, 
-    create_from_template, 
-    get_template_db,
-    set_settings_srid,
-    run_import,
-    run_export,
-    run_update_emission_tables,
-    run_aggregate_emissions, 
-    run_rasterize_emissions,
-    run_get_settings
-)
-from cetk.db import run_migrate
-        
 class Eclair(QWidget):
     def __init__(self, iface):
         super(Eclair, self).__init__()
@@ -132,10 +122,14 @@ class Eclair(QWidget):
         self.action = QAction('Eclair!', self.iface.mainWindow())
         self.action.triggered.connect(self.run)
         self.iface.addToolBarIcon(self.action)
+        QgsMessageLog.logMessage(
+            f"Eclair loaded in {(time.perf_counter() - LOAD_STARTED) * 1000:.0f} ms",
+            MESSAGE_CATEGORY, Qgis.Info)
     
     def unload(self):
         self.iface.removeToolBarIcon(self.action)
         del self.action
+        stop_cetk_workers()
 
     def run(self):
         # Show the widget when the plugin is triggered
@@ -144,20 +138,108 @@ class Eclair(QWidget):
     def show_dock_panel(self):
         # Create or show the dock widget
         if self.dock_widget is None:
-            self.dock_widget = EclairDock(self.iface.mainWindow())
+            started = time.perf_counter()
+            self.dock_widget = EclairDock(self.iface.mainWindow(), install=ask_install_cetk())
             self.iface.addDockWidget(Qt.LeftDockWidgetArea, self.dock_widget)
+            QgsMessageLog.logMessage(
+                f"Eclair panel created in {(time.perf_counter() - started) * 1000:.0f} ms",
+                MESSAGE_CATEGORY, Qgis.Info)
         self.dock_widget.show()
 
 
+def ask_install_cetk():
+    """Return True if cetk is missing and the user wants to install it."""
+    if cetk_installed():
+        return False
+    if QMessageBox.question(None, "Eclair dependencies not installed",
+              "Do you want to install missing python modules? \r\n"
+              "They are installed in the background, see the task manager for progress.",
+               QMessageBox.Ok | QMessageBox.Cancel) == QMessageBox.Ok:
+        return True
+    QMessageBox.information(None,
+                            "Information", "Packages not installed. Eclair will not function unless cetk is installed manually, see https://github.com/foclair/cetk for installation instructions.")
+    return False
+
+
+class SetupTask(QgsTask):
+    """Installs cetk if requested, and creates the template database that
+    new databases are copied from if it does not exist yet."""
+
+    def __init__(self, install=False):
+        super().__init__("Prepare Eclair", QgsTask.Flags())
+        self.install = install
+        self.exception = None
+
+    def run(self):
+        try:
+            if self.install:
+                subprocess.run(
+                    ["python", "-m", "pip", "install", "cetk"],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+                )
+                importlib.invalidate_caches()
+                self.setProgress(50)
+            from cetk.tools.utils import get_template_db
+            if not os.path.exists(get_template_db()):
+                from cetk.db import run_migrate
+                os.makedirs(os.path.dirname(get_template_db()), exist_ok=True)
+                run_migrate()
+        except Exception as e:
+            self.exception = e
+            return False
+        return True
+
+    def finished(self, result):
+        if result:
+            if self.install:
+                QMessageBox.information(None, "Packages successfully installed",
+                                        "To make all parts of the plugin work it is recommended to restart your QGIS-session.")
+            return
+        if isinstance(self.exception, CalledProcessError):
+            error = self.exception.stderr.decode("utf-8")
+        else:
+            error = str(self.exception)
+        QgsMessageLog.logMessage(error, MESSAGE_CATEGORY, Qgis.Warning)
+        if self.install:
+            QMessageBox.information(None, "An error occurred",
+                                    "Eclair couldn't install Python packages!\n"
+                                    "See 'Eclair info' tab in 'Log Messages' panel for details.\n")
+        else:
+            message_box('Template database error', f"Could not create the template database: {error}")
+
+
+# extent, smallest cell size and srid of all rasters of each grid source,
+# read from the GeoPackage tables describing the rasters
+GRIDSOURCE_RASTER_METADATA_SQL = """
+SELECT source.id, source.name,
+    min(coalesce(contents.min_x, matrix_set.min_x)),
+    min(coalesce(contents.min_y, matrix_set.min_y)),
+    max(coalesce(contents.max_x, matrix_set.max_x)),
+    max(coalesce(contents.max_y, matrix_set.max_y)),
+    min(matrix.pixel_x_size),
+    count(DISTINCT srs.organization_coordsys_id),
+    min(srs.organization_coordsys_id)
+FROM edb_gridsource AS source
+JOIN (
+    SELECT source_id, raster FROM edb_gridsourcesubstance
+    UNION SELECT source_id, raster FROM edb_gridsourceactivity
+) AS raster ON raster.source_id = source.id
+JOIN gpkg_contents AS contents ON contents.table_name = 'raster_' || raster.raster
+JOIN gpkg_tile_matrix_set AS matrix_set ON matrix_set.table_name = contents.table_name
+JOIN gpkg_tile_matrix AS matrix ON matrix.table_name = contents.table_name
+    AND matrix.zoom_level = (
+        SELECT max(zoom_level) FROM gpkg_tile_matrix
+        WHERE table_name = contents.table_name
+    )
+LEFT JOIN gpkg_spatial_ref_sys AS srs ON srs.srs_id = contents.srs_id
+GROUP BY source.id
+"""
+
+
 class EclairDock(QDockWidget):
-    def __init__(self, parent):
+    def __init__(self, parent, install=False):
         super().__init__("ECLAIR", parent)
 
-        # Check if template db exists, if not create by migrate
-        if not os.path.exists(get_template_db()):
-            os.makedirs(os.path.dirname(get_template_db()), exist_ok=True)
-            run_migrate()
-
 
         self.setAllowedAreas(Qt.LeftDockWidgetArea | Qt.RightDockWidgetArea)
         # Create a main widget for the dock widget
@@ -191,6 +273,8 @@ class EclairDock(QDockWidget):
         layout_db.setAlignment(Qt.AlignTop)
         self.tab_db.setLayout(layout_db)
         self.db_label = QLabel(self)
+        self.jobs_label = QLabel(self)
+        self.shown_database_jobs = set()
         self.update_db_label()
         layout_db.addWidget(self.db_label)
 
@@ -198,9 +282,47 @@ class EclairDock(QDockWidget):
         layout_db.addWidget(btn_action_existing_database)
         btn_action_existing_database.clicked.connect(self.load_existing_database_dialog)
 
-        btn_action_new_database = QPushButton("Create and connect to new database", self.tab_db)
-        layout_db.addWidget(btn_action_new_database)
-        btn_action_new_database.clicked.connect(self.create_new_database_dialog)
+        self.btn_action_new_database = QPushButton("Create and connect to new database", self.tab_db)
+        layout_db.addWidget(self.btn_action_new_database)
+        self.btn_action_new_database.clicked.connect(self.create_new_database_dialog)
+        # new databases are copied from the template database, which is
+        # created in the background when the panel is first opened
+        self.btn_action_new_database.setEnabled(False)
+        self.btn_action_new_database.setToolTip("Preparing the template database")
+        self.setup_task = SetupTask(install)
+        self.setup_task.taskCompleted.connect(self.setup_finished)
+        self.setup_task.taskTerminated.connect(self.setup_finished)
+        QgsApplication.taskManager().addTask(self.setup_task)
+
+        timeout_layout = QHBoxLayout()
+        timeout_layout.addWidget(QLabel("Maximum duration of tasks [min], 0 = no limit:", self.tab_db))
+        self.timeout_input = QSpinBox(self.tab_db)
+        self.timeout_input.setRange(0, 100000)
+        self.timeout_input.setValue(QgsSettings().value(TASK_TIMEOUT_SETTING, 0, type=int))
+        self.timeout_input.valueChanged.connect(
+            lambda minutes: QgsSettings().setValue(TASK_TIMEOUT_SETTING, minutes)
+        )
+        timeout_layout.addWidget(self.timeout_input)
+        layout_db.addLayout(timeout_layout)
+
+        processes_layout = QHBoxLayout()
+        processes_layout.addWidget(QLabel("Maximum number of parallel cetk processes:", self.tab_db))
+        self.processes_input = QSpinBox(self.tab_db)
+        self.processes_input.setRange(1, 4 * (os.cpu_count() or 1))
+        self.processes_input.setValue(get_max_parallel_processes())
+        self.processes_input.valueChanged.connect(
+            lambda nr: QgsSettings().setValue(PARALLEL_PROCESSES_SETTING, nr)
+        )
+        processes_layout.addWidget(self.processes_input)
+        layout_db.addLayout(processes_layout)
+
+        self.worker_checkbox = QCheckBox("Keep cetk running in the background for faster tasks", self.tab_db)
+        self.worker_checkbox.setChecked(QgsSettings().value(PERSISTENT_WORKER_SETTING, False, type=bool))
+        self.worker_checkbox.toggled.connect(self.toggle_persistent_worker)
+        layout_db.addWidget(self.worker_checkbox)
+
+        layout_db.addWidget(QLabel("Tasks using the database (writing tasks run one at a time):", self.tab_db))
+        layout_db.addWidget(self.jobs_label)
 
         #TODO
         # btn_action_edit_db_settings = QPushButton("Edit database settings", self.tab_db)
@@ -303,12 +425,33 @@ class EclairDock(QDockWidget):
         btn_action_visualize_join_grid = QPushButton("Grids", self.tab_visualize)
         static_sources_layout.addWidget(btn_action_visualize_join_grid)
         btn_action_visualize_join_grid.clicked.connect(self.load_joined_gridsource_canvas)
+        btn_action_visualize_join_all = QPushButton("All", self.tab_visualize)
+        static_sources_layout.addWidget(btn_action_visualize_join_all)
+        btn_action_visualize_join_all.clicked.connect(self.load_joined_sources_canvas)
         layout_visualize.addLayout(static_sources_layout)
 
+    def setup_finished(self):
+        self.btn_action_new_database.setEnabled(True)
+        self.btn_action_new_database.setToolTip("")
+
     def update_db_label(self):
         db_path = os.environ.get("CETK_DATABASE_PATH", "Database not set yet.")
         self.db_label.setText(f"Eclair is currently connected to database:\n {os.path.basename(db_path)}")
         self.db_label.setToolTip(str(db_path))
+        database_jobs = get_database_jobs()
+        if database_jobs.db_path not in self.shown_database_jobs:
+            database_jobs.changed.connect(self.update_jobs_label)
+            self.shown_database_jobs.add(database_jobs.db_path)
+        self.update_jobs_label()
+
+    def update_jobs_label(self):
+        running, queued = get_database_jobs().descriptions()
+        if not running and not queued:
+            self.jobs_label.setText("No tasks are using the database.")
+            return
+        lines = [f"Running: {description}" for description in running]
+        lines += [f"Waiting: {description}" for description in queued]
+        self.jobs_label.setText("\n".join(lines))
 
     def load_existing_database_dialog(self):
         db_path, _ = QFileDialog.getOpenFileName(self.tab_db, "Open SQLite database", "", "Database (*.gpkg)")
@@ -326,6 +469,7 @@ class EclairDock(QDockWidget):
             # user cancelled
             message_box('Warning','No *.gpkg file chosen, database not created.')
         else:
+            from cetk.tools.utils import create_from_template, set_settings_srid
             try:
                 epsg = self.show_srid_dialog()
                 proc = create_from_template(db_path)
@@ -338,6 +482,11 @@ class EclairDock(QDockWidget):
                 error = e.stderr.decode("utf-8")    
                 message_box('Create database error',f"Error: {error}")
 
+    def toggle_persistent_worker(self, checked):
+        QgsSettings().setValue(PERSISTENT_WORKER_SETTING, checked)
+        if not checked:
+            stop_cetk_workers()
+
     def edit_db_settings(self):
         # TODO, create command in cetk.tools.utils that fixes this
         pass
@@ -351,15 +500,30 @@ class EclairDock(QDockWidget):
         self.import_sources_dialog()
 
     def import_sources_dialog(self):
-        file_path, _ = QFileDialog.getOpenFileName(None, "Open spreadsheet with point- and/or areasource data file", "", "Spreadsheet files (*.xlsx)")
-        if file_path: #if file_path not empty string (user did not click cancel)
-            from openpyxl import load_workbook
-            workbook = load_workbook(filename=file_path, data_only=True, read_only=True)
-            # workbook.worksheets  compare to SHEET_NAMES
-            valid_sheets = [sheet.title for sheet in workbook.worksheets if sheet.title in SHEET_NAMES]
-            workbook.close()
+        file_paths, _ = QFileDialog.getOpenFileNames(
+            None,
+            "Open spreadsheets with point- and/or areasource data files",
+            "",
+            "Spreadsheet files (*.xlsx);;Directory with one CSV or Parquet file per sheet (*.csv *.parquet)"
+        )
+        if file_paths: #if file_paths not empty (user did not click cancel)
+            import_paths = []
+            for file_path in file_paths:
+                if Path(file_path).suffix in TABLE_EXTENSIONS:
+                    # all sheets in the directory of the chosen file are imported
+                    file_path = str(Path(file_path).parent)
+                if file_path not in import_paths:
+                    import_paths.append(file_path)
+            file_sheets = [import_file_sheets(file_path) for file_path in import_paths]
+            valid_sheets = [
+                name for name in sheet_names() if any(name in sheets for sheets in file_sheets)
+            ]
+            row_counts = {}
+            for name in valid_sheets:
+                counts = [sheets[name] for sheets in file_sheets if name in sheets]
+                row_counts[name] = None if None in counts else sum(counts)
             
-            checkboxDialog = CheckboxDialog(self,valid_sheets, self.dry_run)
+            checkboxDialog = CheckboxDialog(self,valid_sheets, self.dry_run, row_counts)
             result = checkboxDialog.exec_()  # Show the dialog as a modal dialog
             if result == QDialog.Accepted:
                 sheets = checkboxDialog.sheet_names
@@ -370,7 +534,7 @@ class EclairDock(QDockWidget):
                 else:
                     message_box('Import progress','Dialog closed, data import cancelled. Restart data import and click Import sheets button instead if data import is desired.')
                     return
-                sheets = SHEET_NAMES
+                sheets = sheet_names()
             
             # from qgis.PyQt.QtCore import pyqtRemoveInputHook
             # pyqtRemoveInputHook()
@@ -378,8 +542,29 @@ class EclairDock(QDockWidget):
                 description = "Eclair data validation"
             else:
                 description = "Eclair data import"
-            self.importtask = RunImportTask(description,file_path,sheets)
-            QgsApplication.taskManager().addTask(self.importtask)
+            if len(import_paths) == 1:
+                self.importtask = RunImportTask(description,import_paths[0],sheets,dry_run=self.dry_run)
+                if self.dry_run:
+                    self.importtask.validation_report = ValidationReportDialog(self.importtask)
+                QgsApplication.taskManager().addTask(self.importtask)
+                return
+            # files are imported one after another in the order of the files,
+            # files validated on a copy of the database in parallel, see BatchImport
+            self.batch_import = BatchImport(self.dry_run, import_paths)
+            tasks = []
+            for file_path, sheets_in_file in zip(import_paths, file_sheets):
+                task = RunImportTask(
+                    f"{description} {Path(file_path).name}",
+                    file_path,
+                    [sheet for sheet in sheets if sheet in sheets_in_file],
+                    dry_run=self.dry_run,
+                    batch=self.batch_import
+                )
+                if self.dry_run:
+                    task.validation_report = ValidationReportDialog(task)
+                    task.validation_report.setWindowTitle(f"Validation report {Path(file_path).name}")
+                tasks.append(task)
+            self.batch_import.start(tasks)
         else:
             # user cancelled
             message_box('Import error','No file chosen, no data imported.')
@@ -403,16 +588,20 @@ class EclairDock(QDockWidget):
             QgsApplication.taskManager().addTask(self.task)
     
 
-    def create_emission_table(self):
+    def emission_table_task(self, source_type):
+        """Task updating the emission table of source_type, the layer is loaded when done."""
         #TODO catch exception if database does not have any emissions imported yet       
         db_path = os.environ.get("CETK_DATABASE_PATH", "Database not set yet.")
-        self.task = RunBackgroundTask(
+        return RunBackgroundTask(
                 description="Prepare emissions for static visualisation",
                 function=run_update_emission_tables,
                 parent=self,
                 db_path=db_path,
-                sourcetypes=self.source_type
+                sourcetypes=source_type
         )
+
+    def create_emission_table(self, source_type):
+        self.task = self.emission_table_task(source_type)
         QgsApplication.taskManager().addTask(self.task)
 
 
@@ -449,31 +638,19 @@ class EclairDock(QDockWidget):
                 message_box('Aggregation error',f"Error: {error}")
     
     def rasterize_emissions_dialog(self):
-        self.outputpath = QFileDialog.getExistingDirectory(None, "Choose output directory for raster NetCDF files")
+        self.outputpath = QFileDialog.getExistingDirectory(None, "Choose output directory for raster files")
         if (self.outputpath == ''):
             # user cancelled
             message_box('Rasterize error','No directory chosen, raster files not created.')
         else:
-            # Get a list of files in the directory
-            files_in_directory = os.listdir(self.outputpath)
-            # Filter the list to include only NetCDF files
-            netcdf_files = [file for file in files_in_directory if file.endswith(".nc")]
-            if netcdf_files:
-                message_box("Rasterize","NetCDF files already exist in provided output directory.\n" 
-                + "New rasters will be named after the substances in the emission inventory "
-                + "(for example PM10.nc). Files cannot be overwritten, so if such files already exist, "
-                + "create a new output directory.")
-                self.outputpath = QFileDialog.getExistingDirectory(None, "Choose output directory for raster NetCDF files, where no emissions rasters exist yet.")
             try:
-                rasterDialog = RasterizeDialog(self)
+                rasterDialog = RasterizeDialog(self, self.outputpath)
                 result = rasterDialog.exec_()  # Show the dialog as a modal dialog
                 if result != QDialog.Accepted:
                     # user cancelled
                     message_box('Rasterize error',"No extent, srid and resolution defined, rasterization cancelled.")
                     return
                 self.load_canvas = rasterDialog.load_to_canvas
-                if self.load_canvas:
-                    self.time_threshold = time.time()
                 if rasterDialog.date[0] != '':
                     begin = datetime.datetime.strptime(rasterDialog.date[0], "%Y-%m-%d")
                     end = datetime.datetime.strptime(rasterDialog.date[1], "%Y-%m-%d")
@@ -486,7 +663,10 @@ class EclairDock(QDockWidget):
                         extent=rasterDialog.extent, 
                         srid=rasterDialog.raster_srid,
                         begin=begin,
-                        end=end
+                        end=end,
+                        processes=get_max_parallel_processes(),
+                        output_format=rasterDialog.output_format,
+                        overwrite=rasterDialog.overwrite
                     )
                     
                 else: 
@@ -497,7 +677,10 @@ class EclairDock(QDockWidget):
                         outputpath=self.outputpath, 
                         cellsize=rasterDialog.cell_size, 
                         extent=rasterDialog.extent, 
-                        srid=rasterDialog.raster_srid
+                        srid=rasterDialog.raster_srid,
+                        processes=get_max_parallel_processes(),
+                        output_format=rasterDialog.output_format,
+                        overwrite=rasterDialog.overwrite
                     )
                 
                 QgsApplication.taskManager().addTask(self.task)
@@ -508,17 +691,14 @@ class EclairDock(QDockWidget):
     
 
     def load_joined_pointsource_canvas(self):
-        self.source_type = 'point'
-        self.create_emission_table()
+        self.create_emission_table('point')
 
 
     def load_joined_areasource_canvas(self):
-        self.source_type = 'area'
-        self.create_emission_table()
+        self.create_emission_table('area')
 
     def load_joined_roadsource_canvas(self):
-        self.source_type = 'road'
-        self.create_emission_table()
+        self.create_emission_table('road')
 
 
     def load_joined_gridsource_canvas(self):
@@ -530,83 +710,53 @@ class EclairDock(QDockWidget):
                 return
             connection = sqlite3.connect(self.db_path)
             cursor = connection.cursor()
-            cursor.execute("SELECT id, name FROM edb_gridsource")
+            cursor.execute(GRIDSOURCE_RASTER_METADATA_SQL)
             result = cursor.fetchall()
+            connection.close()
             if len(result) > 0:
                 timestamp = datetime.datetime.now().strftime("%m-%d-%Y_%H-%M")
-                source_id, source_name = zip(*[(x[0], x[1]) for x in result])
-                cursor.execute("SELECT source_id, raster FROM edb_gridsourcesubstance")
-                result = cursor.fetchall()
-                if len(result) > 0:
-                    gss_source_id, gridsourcesubstance_rasters = zip(*[(x[0], x[1]) for x in result])
-                else:
-                    gss_source_id, gridsourcesubstance_rasters = [], []
-                cursor.execute("SELECT source_id, raster FROM edb_gridsourceactivity")
-                result = cursor.fetchall()
-                if len(result) > 0:
-                    gsa_source_id, gridsourceactivity_rasters = zip(*[(x[0], x[1]) for x in result])
-                else:
-                    gsa_source_id, gridsourceactivity_rasters = [], []
-                connection.close()
                 dbname = os.path.basename(self.db_path).split('.')[0]
-                output_path = os.path.join(gettempdir(),dbname)
-                if not os.path.exists(output_path):
-                    os.mkdir(output_path)
                 self.load_canvas = True
-                self.time_threshold = time.time()
-                for id, name in zip(source_id, source_name):
-                    positions = [i for i, x in enumerate(gss_source_id) if x == id]
-                    gss_rasters = [gridsourcesubstance_rasters[i] for i in positions]
-                    positions = [i for i, x in enumerate(gsa_source_id) if x == id]
-                    gsa_rasters = [gridsourceactivity_rasters[i] for i in positions]
-                    unique_rasters = set(gss_rasters + gsa_rasters)
-                    extent=[]
-                    cellsize=[]
-                    srid=[]
-                    for raster in unique_rasters:
-                        raster_layer = QgsRasterLayer(f'GPKG:{self.db_path}:raster_{raster}',raster)
-                        raster_extent = (
-                            raster_layer.dataProvider().extent().xMinimum(),
-                            raster_layer.dataProvider().extent().yMinimum(),
-                            raster_layer.dataProvider().extent().xMaximum(),
-                            raster_layer.dataProvider().extent().yMaximum()
-                        )
-                        extent.append(raster_extent)
-                        cellsize.append((raster_extent[2]-raster_extent[0])/raster_layer.dataProvider().xSize())
-                        srid.append(raster_layer.crs().postgisSrid())
-                    srid=set(srid)
-                    if len(srid) != 1:
+                jobs, outputpaths = [], []
+                for id, name, x1, y1, x2, y2, min_cellsize, nr_srids, srid in result:
+                    if nr_srids != 1:
                         message_box('Load layers error',f"Cannot load grids with undefined or multiple srid for gridsource {name}")
-                    else:
-                        srid = srid.pop()
-                    min_cellsize = min(cellsize)
-                    result_extent = (
-                        min(t[0] for t in extent), 
-                        min(t[1] for t in extent), 
-                        max(t[2] for t in extent), 
-                        max(t[3] for t in extent)
-                    )
-                    self.outputpath = os.path.join(gettempdir(),dbname+'-'+name+'-'+timestamp)
-                    if not os.path.exists(self.outputpath):
-                        os.mkdir(self.outputpath)
-                    else:
-                        old_rasters = os.listdir(self.outputpath)
-                        for file in old_rasters:
-                            os.remove(os.path.join(self.outputpath,file))
-                    # simultaneously running background tasks cannot have the same 
-                    # variable name (eg self.task)
-                    # message_box("rasterize task",f"cell size {min_cellsize}, extent {extent}, srid {srid}, grid_ids {id}")
-                    setattr(self, f'task_{name}', RunBackgroundTask(
-                        description=f"Rasterize emissions {name}",
-                        function=run_rasterize_emissions,
-                        parent=self,
-                        outputpath=self.outputpath, 
-                        cellsize=min_cellsize, 
-                        extent=result_extent, 
+                        continue
+                    result_extent = (x1, y1, x2, y2)
+                    outputpath = os.path.join(GRID_LAYERS_DIR,dbname+'-'+name+'-'+timestamp)
+                    os.makedirs(outputpath, exist_ok=True)
+                    outputpaths.append(outputpath)
+                    jobs.append(rasterize_job(
+                        outputpath,
+                        min_cellsize,
+                        extent=result_extent,
                         srid=srid,
-                        grid_ids=id
+                        grid_ids=[id],
+                        overwrite="overwrite"
                     ))
-                    QgsApplication.taskManager().addTask(getattr(self,f'task_{name}'))
+                if not jobs:
+                    return
+                # rasterize in a bounded number of processes, each process
+                # rasterizes a batch of grid sources one after the other
+                batches = split_in_batches(jobs, get_max_parallel_processes())
+                self.grid_task = TaskGroup(
+                    "Rasterize emissions grid sources",
+                    [
+                        RunBackgroundTask(
+                            description=f"Rasterize emissions grid sources ({i + 1}/{len(batches)})",
+                            function=run_cetk_jobs,
+                            parent=self,
+                            jobs=batch
+                        )
+                        for i, batch in enumerate(batches)
+                    ]
+                )
+                # old layers are removed once the new ones take up space
+                for done in (self.grid_task.taskCompleted, self.grid_task.taskTerminated):
+                    done.connect(lambda: evict_directories(
+                        GRID_LAYERS_DIR, GRID_LAYERS_BYTES, keep=outputpaths
+                    ))
+                QgsApplication.taskManager().addTask(self.grid_task)
             else:
                 message_box("Load layers info","No gridsources exist in database.")
         except CalledProcessError as e:
@@ -614,8 +764,13 @@ class EclairDock(QDockWidget):
             message_box('Load layers error',f"Error: {error}")
 
     def load_joined_sources_canvas(self):
-        for self.source_type in ['point', 'area','road']:
-            self.create_emission_table()
+        # emission tables are calculated in parallel processes, each task
+        # loads the layer of its own source type
+        self.task = TaskGroup(
+            "Prepare emissions for static visualisation of all sources",
+            [self.emission_table_task(source_type) for source_type in ['point', 'area', 'road']]
+        )
+        QgsApplication.taskManager().addTask(self.task)
 
 
     def load_pointsource_canvas(self):
@@ -634,69 +789,32 @@ class EclairDock(QDockWidget):
         self.source_type = 'road'
         self.load_interactive()
 
-    def load_join(self):
+    def load_join(self, source_type, view):
+        """Load the view joining sources with their emissions as a static layer."""
         self.db_path = os.environ.get("CETK_DATABASE_PATH", "Database not set yet.")
         if self.db_path == "Database not set yet.":
             message_box('Warning','Cannot load layer, database not chosen yet.')
             return 
         db_name = os.path.basename(self.db_path).split('.')[0]
         timestamp = datetime.datetime.now().strftime("%m-%d-%Y_%H:%M")
-        if self.source_type == 'point':
-            table = 'edb_pointsource'
-            join_table = 'pointsource_emissions'
+        if source_type == 'point':
             display_name = db_name + '-PointSource' + timestamp
-        elif self.source_type == 'area':
-            table = 'edb_areasource'
-            join_table = 'areasource_emissions'
+        elif source_type == 'area':
             display_name = db_name + '-AreaSource' + timestamp
-        elif self.source_type == 'grid':
-            table = 'edb_gridsource'
-            join_table = 'gridsource_emissions'
-            display_name = db_name + '-GridSource' + timestamp
-        elif self.source_type == 'road':
-            table = 'edb_roadsource'
-            join_table = 'roadsource_emissions'
+        elif source_type == 'road':
             display_name = db_name + '-RoadSource' + timestamp
         else:
             message_box('Warning', f"Cannot load layer, sourcetype {source_type} unknown.")
+            return
 
-        # Create parameters for join by doing join through processing toolbox,
-        # and using the lower button 'Advanced' > 'Copy as Python Command'
-        parameters = { 'DISCARD_NONMATCHING' : False, 
-        'FIELD' : 'id', # id in table for join
-        'FIELDS_TO_COPY' : [], 
-        'FIELD_2' : 'source_id', # id in join_table for join
-        'INPUT' : f"spatialite://dbname=\'{self.db_path}\' table={table} (geom)", 
-        'INPUT_2' : f"spatialite://dbname=\'{self.db_path}\' table={join_table}", 
-        'METHOD' : 1, 
-        'OUTPUT' : 'TEMPORARY_OUTPUT',
-        'PREFIX' : '' }
-        tmp_join = processing.run('qgis:joinattributestable',parameters)['OUTPUT']
-
-        if self.source_type in ["area", "point"]:
-            parameters_codeset_join = {'INPUT':tmp_join, 
-            'FIELD':'activitycode1_id',
-            'INPUT_2':f"spatialite://dbname=\'{self.db_path}\' table=edb_activitycode",
-            'FIELD_2':'id',
-            'FIELDS_TO_COPY':['code','label'],
-            'METHOD':1,
-            'DISCARD_NONMATCHING':False,
-            'PREFIX':'codeset1_',
-            'OUTPUT':'TEMPORARY_OUTPUT'}
-            ac1_join = processing.run('qgis:joinattributestable',parameters_codeset_join)['OUTPUT']
-            
-            parameters_codeset_join['INPUT'] = ac1_join
-            parameters_codeset_join['PREFIX'] = 'codeset2_'
-            parameters_codeset_join['FIELD'] = 'activitycode2_id'
-            ac2_join = processing.run('qgis:joinattributestable',parameters_codeset_join)['OUTPUT']
-
-            parameters_codeset_join['INPUT'] = ac2_join
-            parameters_codeset_join['PREFIX'] = 'codeset3_'
-            parameters_codeset_join['FIELD'] = 'activitycode3_id'
-            self.layer = processing.run('qgis:joinattributestable',parameters_codeset_join)['OUTPUT']
-        else:
-            self.layer = tmp_join
-        self.layer.setName(display_name)
+        # the view is created by the job updating the emission table, it is
+        # loaded as a read-only query layer, no features are copied
+        uri = QgsDataSourceUri()
+        uri.setDatabase(self.db_path)
+        uri.setDataSource('', f"(SELECT * FROM {view})", 'geom', '', 'id')
+        self.layer = QgsVectorLayer(uri.uri(), display_name, 'spatialite')
+        crs = QgsCoordinateReferenceSystem('EPSG:4326')
+        self.layer.setCrs(crs)
         QgsProject.instance().addMapLayer(self.layer)
 
 
@@ -757,10 +875,13 @@ def message_box(title,text):
     msg_box.exec_()
 
 class CheckboxDialog(QDialog):
-    def __init__(self, parent=None, box_labels=None, dry_run=False):
+    def __init__(self, parent=None, box_labels=None, dry_run=False, row_counts=None):
         super().__init__(parent)
         self.box_labels = box_labels
         self.dry_run = dry_run
+        # {sheet: number of rows}, durations are estimated from previous imports
+        self.row_counts = row_counts or {}
+        self.rates = get_import_rates(dry_run)
         self.initUI()
 
     def initUI(self):
@@ -777,11 +898,15 @@ class CheckboxDialog(QDialog):
         # Create checkboxes for each element in box_labels
         self.checkboxes = {}
         for label in self.box_labels:
-            checkbox = QCheckBox(label)
+            checkbox = QCheckBox(self.sheet_label(label))
             checkbox.setChecked(True)  
+            checkbox.toggled.connect(self.update_estimate)
             layout.addWidget(checkbox)
             self.checkboxes[label] = checkbox
 
+        self.estimate_label = QLabel()
+        layout.addWidget(self.estimate_label)
+        self.update_estimate()
         self.setLayout(layout)
 
         if self.dry_run:
@@ -791,19 +916,62 @@ class CheckboxDialog(QDialog):
         layout.addWidget(btn_action_import_sheets)
         btn_action_import_sheets.clicked.connect(self.import_sheets_dialog)
 
+    def sheet_label(self, sheet):
+        nr_rows = self.row_counts.get(sheet)
+        if nr_rows is None:
+            return sheet
+        if sheet in self.rates:
+            return f"{sheet} ({nr_rows:,} rows, {format_duration(nr_rows / self.rates[sheet])})"
+        return f"{sheet} ({nr_rows:,} rows)"
+
+    def update_estimate(self):
+        """Show the estimated duration of the checked sheets."""
+        seconds = sum(
+            self.row_counts[sheet] / self.rates[sheet]
+            for sheet, checkbox in self.checkboxes.items()
+            if checkbox.isChecked() and sheet in self.rates and self.row_counts.get(sheet)
+        )
+        if seconds > 0:
+            self.estimate_label.setText(
+                f"Estimated duration: {format_duration(seconds)}, based on previous "
+                "imports of PointSource and AreaSource sheets."
+            )
+        else:
+            self.estimate_label.setText(
+                "Durations are estimated from previous imports of PointSource "
+                "and AreaSource sheets."
+            )
+
     def import_sheets_dialog(self):
         # Store the state of the checkboxes and close dialog
         self.sheet_names = [label for label in self.box_labels if self.checkboxes[label].isChecked()]
         self.accept()
 
+# labels of the output formats of rasters, see RASTER_FORMATS
+RASTER_FORMAT_LABELS = {
+    "netcdf": "NetCDF, compressed",
+    "geotiff": "Cloud-Optimized GeoTIFF with overviews",
+    "zarr": "Zarr, for hourly rasters",
+    "coo": "Table of cells with emissions",
+}
+# what to do with rasters that already exist in the output directory, see
+# OVERWRITE_POLICIES
+OVERWRITE_POLICY_LABELS = {
+    "error": "Stop if rasters exist",
+    "overwrite": "Overwrite existing rasters",
+    "keep": "Keep existing rasters, only create new ones",
+}
+
+
 class RasterizeDialog(QDialog):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, outputpath=None):
         super().__init__(parent)
+        self.outputpath = outputpath
         self.initUI()
 
     def initUI(self):
-        settings = run_get_settings()
-        
+        self.tasks = []
+
         # Create a layout for the dialog
         self.setWindowTitle("Define rasterize settings")
         layout = QVBoxLayout()
@@ -820,39 +988,36 @@ class RasterizeDialog(QDialog):
         # Initialize with current canvas CRS
         canvas_crs = iface.mapCanvas().mapSettings().destinationCrs()
         canvas_epsg = int(canvas_crs.authid().split(':')[-1])
-        default_epsg = settings.srid
         if canvas_epsg != 4326:
             self.srid_input.setText(str(canvas_epsg))
-        else:
-            self.srid_input.setText(str(default_epsg))
         layout.addWidget(self.srid_input)
 
-        # TODO would be nice to have option 'smallest extent to cover all sources'
         extent_label = QLabel("Enter x and y coordinates for lower left (x1, y1) and upper right (x2, y2) corners of output extent:")
         layout.addWidget(extent_label)
         extent_layout = QHBoxLayout()
         self.extent_input = {}
         self.extent_labels = ["x1:", "y1:", "x2:" ,"y2:"]
-        current_extent = iface.mapCanvas().extent()
-        if canvas_epsg == 4326:
-            # convert from degrees to default_epsg, raster coordinates have to be metric
-            target_crs = QgsCoordinateReferenceSystem(default_epsg)
-            transform = QgsCoordinateTransform(canvas_crs, target_crs, QgsProject.instance())
-            current_extent = transform.transform(current_extent)
-
-        current_corners = {"x1:":floor(current_extent.xMinimum()/1000)*1000,
-            "y1:":floor(current_extent.yMinimum()/1000)*1000, 
-            "x2:":ceil(current_extent.xMaximum()/1000)*1000,
-            "y2:":ceil(current_extent.yMaximum()/1000)*1000}
-
         for label_text in self.extent_labels:
             label = QLabel(label_text)
             extent_layout.addWidget(label)
             line_edit = QLineEdit(self)
             line_edit.setValidator(QDoubleValidator())   
-            line_edit.setText(str(current_corners[label_text]))
             extent_layout.addWidget(line_edit)
             self.extent_input[label_text] = line_edit
+        if canvas_epsg != 4326:
+            self.set_canvas_extent(canvas_crs, canvas_epsg)
+        else:
+            # raster coordinates have to be metric, use the srid of the database
+            # instead, which is read in the background to not block QGIS
+            self.run_job(
+                "Read database settings",
+                lambda event: self.set_database_srid(canvas_crs, event["settings"]["srid"]),
+                "settings",
+            )
+        self.btn_source_extent = QPushButton("Cover all sources")
+        self.btn_source_extent.setToolTip("Smallest extent covering all sources, snapped to the resolution")
+        self.btn_source_extent.clicked.connect(self.set_source_extent)
+        extent_layout.addWidget(self.btn_source_extent)
         layout.addLayout(extent_layout)
 
 
@@ -885,10 +1050,26 @@ class RasterizeDialog(QDialog):
             self.date_input[label_text] = line_edit
         layout.addLayout(date_layout)
 
+        format_layout = QHBoxLayout()
+        format_layout.addWidget(QLabel("Output format:"))
+        self.format_input = QComboBox(self)
+        for output_format, extension in RASTER_FORMATS.items():
+            self.format_input.addItem(f"{RASTER_FORMAT_LABELS[output_format]} ({extension})", output_format)
+        format_layout.addWidget(self.format_input)
+        self.overwrite_input = QComboBox(self)
+        for policy in OVERWRITE_POLICIES:
+            self.overwrite_input.addItem(OVERWRITE_POLICY_LABELS[policy], policy)
+        format_layout.addWidget(self.overwrite_input)
+        layout.addLayout(format_layout)
+
         # Create checkbox
         self.checkbox = QCheckBox("Load rasters to canvas after creation.")
         self.checkbox.setChecked(True)  # Set initial state
         layout.addWidget(self.checkbox)
+        # tables of cells cannot be loaded as rasters
+        self.format_input.currentIndexChanged.connect(
+            lambda index: self.checkbox.setEnabled(self.format_input.itemData(index) != "coo")
+        )
         self.setLayout(layout)
 
         # TODO let unit be user defined?
@@ -896,12 +1077,80 @@ class RasterizeDialog(QDialog):
         layout.addWidget(btn_action_run_rasterizer)
         btn_action_run_rasterizer.clicked.connect(self.run_rasterizer)
 
+    def run_job(self, description, on_result, job, **kwargs):
+        """Run a cetk job in the background, on_result is called with its result."""
+        task = JobResultTask(description, self, on_result, job, **kwargs)
+        self.tasks.append(task)
+        task.taskCompleted.connect(lambda: self.tasks.remove(task))
+        task.taskTerminated.connect(lambda: self.tasks.remove(task))
+        QgsApplication.taskManager().addTask(task)
+        return task
+
+    def done(self, result):
+        # results of jobs still running are not needed anymore
+        for task in list(self.tasks):
+            task.cancel()
+        super().done(result)
+
+    def set_database_srid(self, canvas_crs, srid):
+        if self.srid_input.text() == "":
+            self.srid_input.setText(str(srid))
+            self.set_canvas_extent(canvas_crs, srid)
+
+    def set_canvas_extent(self, canvas_crs, srid):
+        """Fill the extent with the canvas extent in srid, rounded to km."""
+        current_extent = iface.mapCanvas().extent()
+        if canvas_crs.authid() != f"EPSG:{srid}":
+            target_crs = QgsCoordinateReferenceSystem(f"EPSG:{srid}")
+            transform = QgsCoordinateTransform(canvas_crs, target_crs, QgsProject.instance())
+            current_extent = transform.transform(current_extent)
+
+        current_corners = {"x1:":floor(current_extent.xMinimum()/1000)*1000,
+            "y1:":floor(current_extent.yMinimum()/1000)*1000, 
+            "x2:":ceil(current_extent.xMaximum()/1000)*1000,
+            "y2:":ceil(current_extent.yMaximum()/1000)*1000}
+        for label_text in self.extent_labels:
+            self.extent_input[label_text].setText(str(current_corners[label_text]))
+
+    def set_source_extent(self):
+        try:
+            srid = int(self.srid_input.text())
+            cellsize = float(self.resolution_input["resolution [m]"].text())
+        except ValueError:
+            message_box("Rasterize error", "Enter a coordinate system and resolution first.")
+            return
+        if cellsize <= 0:
+            message_box("Rasterize error", "Unvalid resolution, should be a number larger than 0.")
+            return
+        # the extent is computed in the background, the button is enabled
+        # again when it is done
+        self.btn_source_extent.setEnabled(False)
+        task = self.run_job(
+            "Compute extent of sources",
+            lambda event: self.fill_source_extent(event["extent"], cellsize),
+            "source_extent",
+            srid=srid,
+        )
+        task.taskCompleted.connect(lambda: self.btn_source_extent.setEnabled(True))
+        task.taskTerminated.connect(lambda: self.btn_source_extent.setEnabled(True))
+
+    def fill_source_extent(self, extent, cellsize):
+        if extent is None:
+            message_box("Rasterize error", "There are no sources in the database.")
+            return
+        for label, value in zip(self.extent_labels, snap_extent(extent, cellsize)):
+            self.extent_input[label].setText(str(value))
+
     def run_rasterizer(self):
-        self.raster_srid = int(self.srid_input.text())
+        try:
+            self.raster_srid = int(self.srid_input.text())
+            self.extent = [float(self.extent_input[label].text()) for label in self.extent_labels]
+        except ValueError:
+            message_box("Rasterize error", "Enter a coordinate system and extent first.")
+            return
         if self.raster_srid < 1024 or self.raster_srid > 32767:
             message_box("Rasterize error", "EPSG codes defining coordinate systems should be between 1024 and 32767.")
             return
-        self.extent = [float(self.extent_input[label].text()) for label in self.extent_labels]
         if self.extent[2] <= self.extent[0] or self.extent[3] <= self.extent[1]:
             message_box("Rasterize error", "Unvalid extent, x2 should be larger than x1 and y2 larger than y1.")
             return
@@ -940,7 +1189,16 @@ class RasterizeDialog(QDialog):
         # message_box("info",self.extent)
         # Store the state of the checkbox
         
-        self.load_to_canvas = self.checkbox.isChecked()
+        self.output_format = self.format_input.currentData()
+        extension = RASTER_FORMATS[self.output_format]
+        self.overwrite = self.overwrite_input.currentData()
+        if self.overwrite == "error" and self.outputpath is not None:
+            existing = [name for name in os.listdir(self.outputpath) if name.endswith(extension)]
+            if existing:
+                message_box("Rasterize error", f"Rasters already exist in {self.outputpath}, "
+                + "choose to overwrite or keep them, or choose another output directory.")
+                return
+        self.load_to_canvas = self.checkbox.isChecked() and self.output_format != "coo"
         self.accept()
 
 class ChooseCodesetDialog(QDialog):
@@ -1052,55 +1310,887 @@ class TableDialog(QDialog):
         self.adjustSize()
 
 
-def load_rasters_to_canvas(directory_path, time_threshold):
-    # Get a list of files in the directory
-    files_in_directory = os.listdir(directory_path)
-    # Filter the list to include only files modified after the time threshold
-    modified_rasters = [
-        file for file in files_in_directory 
-        if (os.path.getmtime(os.path.join(directory_path, file)) > time_threshold)
-        and file.endswith(".nc")
-    ]
-    # Check if there are any modified files
-    if modified_rasters:
+class ValidationReportModel(QAbstractTableModel):
+    """Validation messages, read on demand from the events file of a validation.
+
+    Only the position in the file and the sheet of each message are kept in
+    memory, so the model stays small for any number of messages.
+    """
+    columns = ["sheet", "row", "column", "message"]
+    max_cached_rows = 1000
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.events_path = None
+        self.offsets = array("q")
+        self.sheet_ids = array("H")
+        self.sheets = []
+        self.cached_rows = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.offsets)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.columns[section]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        value = self.read_row(index.row())[self.columns[index.column()]]
+        return "" if value is None else str(value)
+
+    def read_row(self, row):
+        if row not in self.cached_rows:
+            if len(self.cached_rows) >= self.max_cached_rows:
+                self.cached_rows.clear()
+            with open(self.events_path, encoding="utf-8") as events:
+                events.seek(self.offsets[row])
+                self.cached_rows[row] = json.loads(events.readline())
+        return self.cached_rows[row]
+
+    def add_messages(self, events_path, messages):
+        """Add [(offset, sheet), ...] of messages in the events file."""
+        self.events_path = events_path
+        first = len(self.offsets)
+        self.beginInsertRows(QModelIndex(), first, first + len(messages) - 1)
+        for offset, sheet in messages:
+            if sheet not in self.sheets:
+                self.sheets.append(sheet)
+            self.offsets.append(offset)
+            self.sheet_ids.append(self.sheets.index(sheet))
+        self.endInsertRows()
+
+    def iter_rows(self, sheet=None):
+        """Iterate over all messages, optionally only for one sheet."""
+        if self.events_path is None:
+            return
+        with open(self.events_path, encoding="utf-8") as events:
+            for line in events:
+                event = json.loads(line)
+                if event["event"] == "validation" and sheet in (None, event["sheet"]):
+                    yield event
+
+
+class SheetFilterProxyModel(QSortFilterProxyModel):
+    """Shows the validation messages of one sheet, or of all sheets if sheet is None."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.sheet = None
+
+    def set_sheet(self, sheet):
+        self.sheet = sheet
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if self.sheet is None:
+            return True
+        model = self.sourceModel()
+        return model.sheets[model.sheet_ids[source_row]] == self.sheet
+
+
+class ValidationReportDialog(QDialog):
+    """Shows validation messages of an import task while they are reported."""
+
+    def __init__(self, task):
+        super().__init__()
+        self.model = ValidationReportModel(self)
+        task.validationMessages.connect(self.add_messages)
+        self.initUI()
+
+    def initUI(self):
+        self.setWindowTitle("Validation report")
+        layout = QVBoxLayout()
+        self.status_label = QLabel("Validating, errors are listed as they are found.")
+        layout.addWidget(self.status_label)
+
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(QLabel("Sheet:"))
+        self.sheet_input = QComboBox(self)
+        self.sheet_input.addItem("All sheets")
+        self.sheet_input.currentIndexChanged.connect(self.filter_sheet)
+        filter_layout.addWidget(self.sheet_input)
+        btn_action_export = QPushButton("Export to CSV")
+        btn_action_export.clicked.connect(self.export_csv)
+        filter_layout.addWidget(btn_action_export)
+        layout.addLayout(filter_layout)
+
+        self.proxy_model = SheetFilterProxyModel(self)
+        self.proxy_model.setSourceModel(self.model)
+        table_view = QTableView(self)
+        table_view.setModel(self.proxy_model)
+        # uniform row heights, so only visible rows have to be read and laid out
+        table_view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        table_view.horizontalHeader().setStretchLastSection(True)
+        table_view.setWordWrap(False)
+        layout.addWidget(table_view)
+        self.setLayout(layout)
+        self.resize(900, 500)
+
+    def add_messages(self, events_path, messages):
+        self.model.add_messages(events_path, messages)
+        for sheet in self.model.sheets[self.sheet_input.count() - 1:]:
+            self.sheet_input.addItem(sheet or "(sheet unknown)", sheet)
+        if not self.isVisible():
+            self.show()
+
+    def set_status(self, text):
+        self.status_label.setText(text)
+        self.show()
+        self.raise_()
+
+    def filter_sheet(self, index):
+        self.proxy_model.set_sheet(None if index == 0 else self.sheet_input.itemData(index))
+
+    def export_csv(self):
+        filename, _ = QFileDialog.getSaveFileName(self, "Export validation report", "", "(*.csv)")
+        if filename == '':
+            return
+        if not filename.endswith('.csv'):
+            filename += '.csv'
+        with open(filename, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=self.model.columns, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(self.model.iter_rows(self.proxy_model.sheet))
+
+
+def load_rasters_to_canvas(directory_path, raster_files):
+    """Add rasters in directory_path to a new group in the project.
+
+    Only rasters with emissions are passed, the rasterize job checks
+    the files for non-zero values so no statistics are calculated here.
+    """
+    if raster_files:
         project = QgsProject.instance()
         group_name = Path(directory_path).name
         root = project.layerTreeRoot()
         grp = root.addGroup(group_name)
         
-        for raster_file in modified_rasters:
+        for raster_file in raster_files:
             # Construct the full path to the raster file
             full_path = os.path.join(directory_path, raster_file)
+            if raster_file.endswith(".zarr"):
+                # open the emission array of the store
+                substance = raster_file[:-len(".zarr")]
+                full_path = f'ZARR:"{full_path}":/emission_{substance}'
+
             # Create a raster layer
             raster_layer = QgsRasterLayer(full_path, raster_file, "gdal")
-            # statistics band 1
-            provider = raster_layer.dataProvider()
-            stats = provider.bandStatistics(1, QgsRasterBandStats.All)
-            # only visualize non-zero rasters:
-            if stats.sum > 0:
-                # Add the raster layer to the project
-                project.addMapLayer(raster_layer, False)
-                grp.insertChildNode(1, QgsLayerTreeLayer(raster_layer))
+            # Add the raster layer to the project
+            project.addMapLayer(raster_layer, False)
+            grp.insertChildNode(1, QgsLayerTreeLayer(raster_layer))
+
+
+
+# seconds between checks for cancellation while a task waits for cetk
+CETK_POLL_INTERVAL = 0.2
+# seconds to wait for cetk to exit after terminate, before it is killed
+CETK_TERMINATE_TIMEOUT = 5
+# maximum duration of cetk tasks in minutes, 0 means no limit
+TASK_TIMEOUT_SETTING = "eclair/task_timeout"
+# maximum number of cetk processes run in parallel by a task
+PARALLEL_PROCESSES_SETTING = "eclair/max_parallel_processes"
+# keep a cetk process running to run jobs for the connected database
+PERSISTENT_WORKER_SETTING = "eclair/persistent_worker"
+# rasters of grid source layers, the least recently created are removed when
+# they take more than GRID_LAYERS_BYTES
+GRID_LAYERS_DIR = os.path.join(gettempdir(), "eclair_grid_layers")
+GRID_LAYERS_BYTES = 1024 * 1024 * 1024
+# rows per second of previous imports and validations of a sheet
+IMPORT_RATE_SETTING = "eclair/{mode}_rows_per_second/{sheet}"
+
+
+CETK_RUNNER = os.path.join(os.path.dirname(__file__), "cetk_runner.py")
+
+
+def get_cetk_python():
+    """Return the command of the python interpreter that cetk is installed for."""
+    if os.name == "nt":
+        return ["python"]
+    cetk_script = shutil.which("cetk")
+    if cetk_script is not None:
+        with open(cetk_script) as f:
+            first_line = f.readline()
+        if first_line.startswith("#!"):
+            return shlex.split(first_line[2:])
+    return ["python3"]
+
+
+def start_process(name, args, db_path=None, stdin=None):
+    """Start a sub-process without waiting for it.
+
+    stdout and stderr are written to log files in a temporary directory
+    owned by the caller, available as proc.stdout_path and proc.stderr_path.
+    """
+    env = (
+        os.environ
+        if db_path is None
+        else {**os.environ, "CETK_DATABASE_PATH": str(db_path)}
+    )
+    log_dir = mkdtemp(prefix=f"{name}_")
+    stdout_path = os.path.join(log_dir, "stdout.log")
+    stderr_path = os.path.join(log_dir, "stderr.log")
+    # in a process group of its own, so that the process and its children
+    # can be stopped together, see stop_cetk
+    if os.name == "nt":
+        group_options = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        group_options = {"start_new_session": True}
+    with open(stdout_path, "w") as stdout_file, open(stderr_path, "w") as stderr_file:
+        proc = subprocess.Popen(
+            args,
+            stdin=stdin,
+            stdout=stdout_file,
+            stderr=stderr_file,
+            universal_newlines=True,
+            env=env,
+            **group_options,
+        )
+    proc.log_dir = log_dir
+    proc.stdout_path = stdout_path
+    proc.stderr_path = stderr_path
+    proc.events_path = None
+    proc.nr_jobs = 0
+    return proc
+
+
+def run_cetk_jobs(jobs, db_path=None):
+    """Start jobs of cetk_runner.py, one after the other in a single sub-process.
+
+    A job is a dict with the name of the job as "job" and its keyword arguments.
+    The events reported by the jobs are written to proc.events_path.
+    If enabled in the settings, the jobs are sent to the worker process of
+    the database instead, see CetkWorker.
+    """
+    worker = get_cetk_worker(db_path)
+    if worker is not None:
+        proc = worker.submit(jobs)
+        if proc is not None:
+            return proc
+    proc = start_process(
+        f"cetk_{jobs[0]['job']}",
+        [*get_cetk_python(), CETK_RUNNER],
+        db_path=db_path,
+        stdin=subprocess.PIPE,
+    )
+    proc.events_path = os.path.join(proc.log_dir, "events.jsonl")
+    proc.nr_jobs = len(jobs)
+    for job in jobs:
+        proc.stdin.write(json.dumps({**job, "events": proc.events_path}) + "\n")
+    proc.stdin.close()
+    return proc
+
+
+def run_cetk_job(job, db_path=None, **kwargs):
+    """Start a single job of cetk_runner.py in a sub-process."""
+    return run_cetk_jobs([{"job": job, **kwargs}], db_path=db_path)
+
+
+class CetkWorker:
+    """A cetk_runner.py process that is kept running to run jobs for one database.
+
+    Starting python, django and the database connection is only done once,
+    jobs are sent to the process over its stdin.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.proc = None
+        self.jobs = None
+        self.lock = threading.RLock()
+
+    def submit(self, jobs):
+        """Send jobs to the worker, starting it if it is not running.
+
+        Returns a WorkerJobs to wait for the jobs, or None if the worker is
+        busy with other jobs or has died, the jobs should then be run in a
+        separate process to not wait for each other.
+        """
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.proc = start_process(
+                    "cetk_worker",
+                    [*get_cetk_python(), CETK_RUNNER],
+                    db_path=self.db_path,
+                    stdin=subprocess.PIPE,
+                )
+            elif self.jobs is not None and self.jobs.returncode is None:
+                return None
+            log_dir = mkdtemp(prefix=f"cetk_{jobs[0]['job']}_")
+            events_path = os.path.join(log_dir, "events.jsonl")
+            try:
+                for job in jobs:
+                    self.proc.stdin.write(json.dumps({**job, "events": events_path}) + "\n")
+                self.proc.stdin.flush()
+            except OSError:
+                self.stop()
+                return None
+            self.jobs = WorkerJobs(self, log_dir, events_path, len(jobs))
+            return self.jobs
+
+    def stop(self):
+        with self.lock:
+            if self.proc is not None:
+                try:
+                    self.proc.stdin.close()
+                except OSError:
+                    pass
+                stop_cetk(self.proc)
+                self.proc = None
+
+
+class WorkerJobs:
+    """Jobs sent to a CetkWorker, they can be waited for like a process."""
+
+    def __init__(self, worker, log_dir, events_path, nr_jobs):
+        self.worker = worker
+        self.proc = worker.proc
+        self.log_dir = log_dir
+        self.events_path = events_path
+        self.stdout_path = self.proc.stdout_path
+        self.stderr_path = self.proc.stderr_path
+        self.nr_jobs = nr_jobs
+        self.statuses = []
+        self.returncode = None
+        self.log = CetkLog(events_path)
+
+    def poll(self):
+        if self.returncode is None:
+            for offset, line in self.log.new_lines():
+                event = json.loads(line)
+                if event["event"] == "done":
+                    self.statuses.append(event["status"])
+            if len(self.statuses) == self.nr_jobs:
+                self.returncode = max(self.statuses)
+            elif self.proc.poll() is not None:
+                # the worker died before all jobs were done
+                self.returncode = self.proc.returncode or 1
+        return self.returncode
+
+    def wait(self, timeout=None):
+        started = time.monotonic()
+        while self.poll() is None:
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise subprocess.TimeoutExpired(CETK_RUNNER, timeout)
+            time.sleep(min(CETK_POLL_INTERVAL, timeout or CETK_POLL_INTERVAL))
+        return self.returncode
+
+
+
+# persistent worker processes by database path
+CETK_WORKERS = {}
+CETK_WORKERS_LOCK = threading.Lock()
+
+
+def get_cetk_worker(db_path=None):
+    """Return the worker of the connected database, None if workers are disabled.
+
+    Jobs for other databases, e.g. a copy used to validate an import, are not
+    run by a worker.
+    """
+    if not QgsSettings().value(PERSISTENT_WORKER_SETTING, False, type=bool):
+        return None
+    connected_db = os.environ.get("CETK_DATABASE_PATH")
+    if connected_db is None or (db_path is not None and str(db_path) != connected_db):
+        return None
+    # tasks get the worker from their own threads
+    with CETK_WORKERS_LOCK:
+        if connected_db not in CETK_WORKERS:
+            CETK_WORKERS[connected_db] = CetkWorker(connected_db)
+        return CETK_WORKERS[connected_db]
+
+
+def stop_cetk_workers():
+    with CETK_WORKERS_LOCK:
+        workers = list(CETK_WORKERS.values())
+        CETK_WORKERS.clear()
+    for worker in workers:
+        worker.stop()
+
+
+class DatabaseJob:
+    def __init__(self, description, write=False, group=None):
+        self.description = description
+        self.write = write
+        self.group = group
+
+    def can_run_with(self, other):
+        if not self.write and not other.write:
+            return True
+        return self.write and other.write and self.group is not None and self.group == other.group
+
+
+class DatabaseJobs(QObject):
+    """Schedules the tasks using the same database.
+
+    Jobs that only read from the database run in parallel, jobs that write to it
+    run alone, except for writers of the same group that take care of conflicts
+    themselves. Jobs start in the order they were queued.
+    """
+
+    # emitted from task threads when jobs are queued, started or done
+    changed = pyqtSignal()
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = db_path
+        self.condition = threading.Condition()
+        self.queued = []
+        self.running = []
+
+    def can_start(self, job):
+        return self.queued[0] is job and all(job.can_run_with(other) for other in self.running)
+
+    def acquire(self, task, write=False, group=None):
+        """Wait until the job of task can start.
+
+        Returns the job, or None if the task was cancelled while waiting.
+        """
+        job = DatabaseJob(task.description(), write, group)
+        with self.condition:
+            self.queued.append(job)
+        self.changed.emit()
+        with self.condition:
+            while not self.can_start(job):
+                if task.isCanceled():
+                    self.queued.remove(job)
+                    self.condition.notify_all()
+                    break
+                self.condition.wait(CETK_POLL_INTERVAL)
+            else:
+                self.queued.remove(job)
+                self.running.append(job)
+                self.condition.notify_all()
+        self.changed.emit()
+        return job if job in self.running else None
+
+    def release(self, job):
+        with self.condition:
+            self.running.remove(job)
+            self.condition.notify_all()
+        self.changed.emit()
+
+    @contextmanager
+    def access(self, task, write=False, group=None):
+        """Context in which task may use the database, as True if it has started."""
+        job = self.acquire(task, write, group)
+        try:
+            yield job is not None
+        finally:
+            if job is not None:
+                self.release(job)
+
+    def descriptions(self):
+        """Return the descriptions of running and queued jobs."""
+        with self.condition:
+            return (
+                [job.description for job in self.running],
+                [job.description for job in self.queued],
+            )
+
+
+# job schedulers by database path
+DATABASE_JOBS = {}
 
 
+def get_database_jobs(db_path=None):
+    """Return the scheduler of jobs for a database, by default the connected database."""
+    db_path = str(db_path or os.environ.get("CETK_DATABASE_PATH", ""))
+    if db_path not in DATABASE_JOBS:
+        DATABASE_JOBS[db_path] = DatabaseJobs(db_path)
+    return DATABASE_JOBS[db_path]
+
+
+def snap_extent(extent, cellsize):
+    """Extend extent to the nearest multiples of cellsize."""
+    x1, y1, x2, y2 = extent
+    return [
+        floor(x1 / cellsize) * cellsize,
+        floor(y1 / cellsize) * cellsize,
+        max(ceil(x2 / cellsize), floor(x1 / cellsize) + 1) * cellsize,
+        max(ceil(y2 / cellsize), floor(y1 / cellsize) + 1) * cellsize,
+    ]
+
+
+def evict_directories(parent, max_bytes, keep=()):
+    """Remove the least recently modified directories in parent until the
+    files in them take at most max_bytes, except for the directories in keep
+    and those with files of layers in the current project."""
+    if not os.path.isdir(parent):
+        return
+    # sources of layers are paths, or URIs of GDAL drivers containing paths
+    sources = [
+        os.path.normcase(layer.source()).replace("\\", "/")
+        for layer in QgsProject.instance().mapLayers().values()
+    ]
+    directories = []
+    for entry in os.scandir(parent):
+        if entry.is_dir():
+            size = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(entry.path)
+                for name in names
+            )
+            directories.append((entry.stat().st_mtime, size, entry.path))
+    total = sum(size for _, size, _ in directories)
+    keep = {os.path.normpath(path) for path in keep}
+    for _, size, path in sorted(directories):
+        if total <= max_bytes:
+            break
+        if os.path.normpath(path) in keep:
+            continue
+        prefix = os.path.normcase(os.path.normpath(path)).replace("\\", "/") + "/"
+        if any(prefix in source for source in sources):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def get_max_parallel_processes():
+    """Maximum number of cetk processes a task may run in parallel."""
+    return QgsSettings().value(PARALLEL_PROCESSES_SETTING, os.cpu_count() or 1, type=int)
+
+
+def split_in_batches(items, nr_batches):
+    """Split items in at most nr_batches lists of (about) equal length."""
+    nr_batches = max(1, min(nr_batches, len(items)))
+    return [items[i::nr_batches] for i in range(nr_batches)]
+
+
+def import_file_sheets(file_path):
+    """Return {sheet: number of rows} of the sheets in SHEET_NAMES of a
+    spreadsheet, or of a directory with one CSV or Parquet file per sheet,
+    e.g. PointSource.csv.
+
+    Rows are counted without reading the cells, from the dimension of a
+    spreadsheet, and are None if they cannot be counted.
+    """
+    if os.path.isdir(file_path):
+        sheets = {}
+        for name in sheet_names():
+            for ext in TABLE_EXTENSIONS:
+                path = Path(file_path) / (name + ext)
+                if path.is_file():
+                    sheets[name] = table_row_count(path)
+                    break
+        return sheets
+    from openpyxl import load_workbook
+    workbook = load_workbook(filename=file_path, data_only=True, read_only=True)
+    # workbook.worksheets  compare to SHEET_NAMES
+    valid_sheets = {
+        sheet.title: None if sheet.max_row is None else max(sheet.max_row - 1, 0)
+        for sheet in workbook.worksheets if sheet.title in sheet_names()
+    }
+    workbook.close()
+    return valid_sheets
+
+
+def get_import_rates(dry_run):
+    """Return {sheet: rows per second} of previous imports (or validations)."""
+    settings = QgsSettings()
+    mode = "validation" if dry_run else "import"
+    rates = {}
+    for sheet in sheet_names():
+        rate = settings.value(IMPORT_RATE_SETTING.format(mode=mode, sheet=sheet), 0, type=float)
+        if rate > 0:
+            rates[sheet] = rate
+    return rates
+
+
+def record_import_rates(timings, dry_run):
+    """Store the rows per second of an import, averaged with previous imports."""
+    settings = QgsSettings()
+    mode = "validation" if dry_run else "import"
+    previous = get_import_rates(dry_run)
+    for sheet, timing in timings.items():
+        if timing["rows"] == 0 or timing["seconds"] <= 0:
+            continue
+        rate = timing["rows"] / timing["seconds"]
+        if sheet in previous:
+            rate = (rate + previous[sheet]) / 2
+        settings.setValue(IMPORT_RATE_SETTING.format(mode=mode, sheet=sheet), rate)
+
+
+def format_duration(seconds):
+    minutes = round(seconds / 60)
+    if minutes < 1:
+        return "less than a minute"
+    if minutes < 60:
+        return f"{minutes} min"
+    return f"{minutes // 60} h {minutes % 60} min"
+
+
+def validates_on_copy(sheets, dry_run):
+    """Return True if sheets have to be validated on a copy of the database.
+
+    Sheets are validated in a transaction that is rolled back, but cetk also
+    imports the rasters of grid sources when validating, using its own
+    connection to the database.
+    """
+    return dry_run and "GridSource" in sheets
+
+
+def copy_database():
+    """Copy the connected database to a new temporary directory."""
+    db_path = os.environ.get("CETK_DATABASE_PATH")
+    if db_path is None:
+        raise ValueError("No database specified, set by $CETK_DATABASE_PATH\n")
+    copy_path = Path(mkdtemp(prefix="eclair_validation_")) / Path(db_path).name
+    shutil.copyfile(db_path, copy_path)
+    return copy_path
+
+
+def run_import(filename, sheets, dry_run=False, on_copy=None):
+    """Import (or validate, if dry_run) sheets of a spreadsheet.
+
+    Sheets are validated on a copy of the database if on_copy, by default
+    only if validates_on_copy. Returns the path of the copy of the database
+    that is validated, if any, and the process.
+    """
+    if on_copy is None:
+        on_copy = validates_on_copy(sheets, dry_run)
+    if on_copy:
+        backup_path = copy_database()
+        return backup_path, run_cetk_job(
+            "import", db_path=backup_path, filename=filename, sheets=sheets, dry_run=True
+        )
+    return None, run_cetk_job("import", filename=filename, sheets=sheets, dry_run=dry_run)
+
+
+def run_export(filename):
+    return run_cetk_job("export", filename=filename)
+
+
+def run_update_emission_tables(db_path=None, sourcetypes=None):
+    """Update emission tables, only emissions of sources changed since the
+    last update are recomputed."""
+    return run_cetk_job(
+        "update_emission_tables", db_path=db_path, sourcetypes=sourcetypes
+    )
+
+
+def run_aggregate_emissions(filename, codeset=None):
+    return run_cetk_job("aggregate", filename=filename, codeset=codeset)
+
+
+def rasterize_job(outputpath, cellsize, begin=None, end=None, **kwargs):
+    """Job for cetk_runner.py to rasterize emissions to files in outputpath."""
+    return {
+        "job": "rasterize",
+        "outputpath": str(outputpath),
+        "cellsize": cellsize,
+        "begin": None if begin is None else begin.isoformat(),
+        "end": None if end is None else end.isoformat(),
+        **kwargs,
+    }
+
+
+def run_rasterize_emissions(outputpath, cellsize, **kwargs):
+    return run_cetk_jobs([rasterize_job(outputpath, cellsize, **kwargs)])
+
+
+# functions run by RunBackgroundTask that write to the database, by group
+# of writers that can run in parallel, see DatabaseJobs
+WRITING_JOBS = {
+    run_update_emission_tables: "emission tables",
+}
+
+
+class CetkLog:
+    """Reads the lines a running cetk process appends to a log file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.position = 0
+
+    def new_lines(self):
+        """Return (offset, line) of complete lines written since the last call."""
+        lines = []
+        if not os.path.exists(self.path):
+            return lines
+        with open(self.path, encoding="utf-8") as log:
+            log.seek(self.position)
+            while True:
+                offset = self.position
+                line = log.readline()
+                if not line.endswith("\n"):
+                    break
+                self.position = log.tell()
+                lines.append((offset, line.rstrip("\n")))
+        return lines
+
+    def new_events(self, structured=True):
+        """Return events written since the last call.
+
+        The position of each event in the file is added as event["offset"].
+        If not structured, lines of plain log output are converted to
+        progress events when cetk reports a percentage, other lines are skipped.
+        """
+        if structured:
+            return [
+                {**json.loads(line), "offset": offset}
+                for offset, line in self.new_lines()
+            ]
+        events = []
+        for offset, line in self.new_lines():
+            match = PROGRESS_PATTERN.search(line)
+            if match:
+                events.append({"event": "progress", "value": float(match.group(1))})
+        return events
+
+
+def get_task_timeout():
+    """Maximum duration of a cetk task in seconds, None if unlimited."""
+    minutes = QgsSettings().value(TASK_TIMEOUT_SETTING, 0, type=int)
+    return minutes * 60 if minutes > 0 else None
+
+
+def signal_cetk(proc):
+    """Ask a cetk process and its children to stop, without waiting for them.
+
+    cetk_runner.py rolls back open transactions before it exits.
+    Jobs of a worker cannot be interrupted, the worker itself is stopped.
+    """
+    if isinstance(proc, WorkerJobs):
+        proc = proc.proc
+    try:
+        if os.name == "nt":
+            proc.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            os.killpg(proc.pid, signal.SIGTERM)
+    except (ProcessLookupError, OSError):
+        # already exited
+        pass
+
+
+def kill_cetk(proc):
+    """Kill a cetk process and its children."""
+    if os.name == "nt":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(proc.pid)], capture_output=True
+        )
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def stop_cetk(proc):
+    """Stop a cetk process and its children and wait until it has exited.
+
+    The process is killed if it does not exit within CETK_TERMINATE_TIMEOUT
+    seconds, the database is then restored by the next connection to it.
+    """
+    if isinstance(proc, WorkerJobs):
+        proc.worker.stop()
+        proc.poll()
+        return
+    signal_cetk(proc)
+    try:
+        proc.wait(timeout=CETK_TERMINATE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        pass
+    # also kills children that are left when cetk has exited
+    kill_cetk(proc)
+    proc.wait()
+
+
+def wait_for_cetk(task, proc, timeout=None, on_events=None, on_progress=None):
+    """Block until the cetk process exits or the task is cancelled.
+
+    Returns True when the process has exited, False if the task was cancelled.
+    If the process runs longer than timeout seconds, it is stopped and a
+    TimeoutError is raised. Progress reported by cetk is passed to on_progress,
+    by default it is set on the task. All other events are passed on as lists
+    to on_events as they arrive, before the progress reported after them.
+    """
+    if on_progress is None:
+        on_progress = task.setProgress
+    structured = proc.events_path is not None
+    log = CetkLog(proc.events_path if structured else proc.stderr_path)
+    started = time.monotonic()
+    while True:
+        try:
+            proc.wait(timeout=CETK_POLL_INTERVAL)
+            exited = True
+        except subprocess.TimeoutExpired:
+            exited = False
+        events = []
+        for event in log.new_events(structured):
+            if event["event"] != "progress":
+                events.append(event)
+                continue
+            if events and on_events is not None:
+                on_events(events)
+            events = []
+            on_progress(event["value"])
+        if events and on_events is not None:
+            on_events(events)
+        if exited:
+            return True
+        if task.isCanceled():
+            stop_cetk(proc)
+            return False
+        if timeout is not None and time.monotonic() - started > timeout:
+            stop_cetk(proc)
+            raise TimeoutError(
+                f"{task.description()} did not finish within {timeout / 60:g} minutes,"
+                " the maximum duration can be changed under 'DB Settings'."
+            )
+
 
 MESSAGE_CATEGORY = "Eclair info"
 
 class RunImportTask(QgsTask):
-    def __init__(self, description, file_path, sheets, dry_run=False):
+    # path of events file and [(offset, sheet), ...] of new validation messages
+    validationMessages = pyqtSignal(str, list)
+
+    def __init__(self, description, file_path, sheets, dry_run=False, batch=None):
         super().__init__(description, QgsTask.CanCancel)
         self.file_path = file_path
         self.sheets = sheets
-        if "validation" in self.description():
-            self.dry_run = True
-        else:
-            self.dry_run = False
+        self.dry_run = dry_run
+        self.batch = batch
+        self.on_copy = validates_on_copy(sheets, self.dry_run)
+        self.timeout = get_task_timeout()
         self.exception = None
+        self.backup_path = None
+        self.validation_msgs = []
+        self.nr_validation_msgs = 0
+        self.changes = {}
+        # {sheet: {"rows": ..., "seconds": ...}} of sheets imported in batches
+        self.timings = {}
+        self.traceback = None
+        self.proc = None
+        self.database_jobs = get_database_jobs()
 
-    def check_process_ready(self):
-        if self.proc:
-            return self.proc.poll() is not None
-        return False
+    def handle_events(self, events):
+        """Collect results reported by the import job.
+
+        Validation messages of a dry run are only counted here, they are
+        streamed to the validation report which reads them from the events file.
+        """
+        validation_msgs = []
+        for event in events:
+            if event["event"] == "validation":
+                validation_msgs.append((event["offset"], event["sheet"]))
+                if not self.dry_run:
+                    self.validation_msgs.append(event["message"])
+            elif event["event"] == "result":
+                self.changes = event["updates"]
+                self.timings = event.get("timings", {})
+            elif event["event"] == "error":
+                self.error_message = event["message"]
+                self.traceback = event["traceback"]
+        if validation_msgs:
+            self.nr_validation_msgs += len(validation_msgs)
+            self.validationMessages.emit(self.proc.events_path, validation_msgs)
 
     def run(self):
         """Implement heavy lifting.
@@ -1108,28 +2198,32 @@ class RunImportTask(QgsTask):
         Raising exceptions here will crash QGIS, raise them in self.finished instead.
         """
         QgsMessageLog.logMessage('Started import task', MESSAGE_CATEGORY, Qgis.Info)
+        # validation in a transaction locks the database like an import,
+        # validation on a copy only reads the database to copy it
+        with self.database_jobs.access(self, write=not self.on_copy) as started:
+            if not started:
+                return False
+            return self.run_import()
+
+    def run_import(self):
         try:
-            self.backup_path, self.proc = run_import(self.file_path, self.sheets, dry_run=self.dry_run)
-            for i in range(3600):
-                # Check if the file size is greater than zero
-                if self.check_process_ready(): 
-                    return True
+            self.backup_path, self.proc = run_import(
+                self.file_path, self.sheets, dry_run=self.dry_run, on_copy=self.on_copy
+            )
+            if not wait_for_cetk(self, self.proc, self.timeout, self.handle_events):
+                if self.dry_run:
+                    self.exception = "Validation cancelled by user"
                 else:
-                    if self.isCanceled():
-                        if self.dry_run:
-                            self.exception = "Validation cancelled by user"
-                        else:
-                            self.exception = "Import cancelled by user"
-                        self.cancel()
-                        return False
-                    time.sleep(1)
-                    # set progress 1 % per second first 50 seconds
-                    # second half progress estimation based on max 20min 
-                    if i < 51:
-                        self.setProgress(i)
-                    else:
-                        self.setProgress(50+i/1150.*50.)
-            self.exception = "Failed to import file within one hour, decrease file size"
+                    self.exception = "Import cancelled by user"
+                self.cancel()
+                return False
+            if self.traceback is not None and "does not exist, first run 'cetk create'" in self.error_message:
+                self.exception = self.error_message
+                return False
+            if self.proc.returncode != 0 and self.traceback is None:
+                # cetk failed before it could report anything
+                with open(self.proc.stderr_path, 'r') as f:
+                    self.traceback = f.read()
         except Exception as e:
             self.exception =  e
             return False
@@ -1141,61 +2235,29 @@ class RunImportTask(QgsTask):
         This function is automatically called when the task has
         completed (successfully or not). Result is the return value from self.run
         """
+        # sheets with errors are not completely imported, their rates are not kept
+        if result and self.traceback is None and self.nr_validation_msgs == 0:
+            record_import_rates(self.timings, self.dry_run)
+        if self.batch is not None:
+            self.finish_batch(result)
+            return
         if result:
             QgsMessageLog.logMessage(
                 'Task "{name}" completed\n'.format(name=self.description()),
                 MESSAGE_CATEGORY, Qgis.Success)
-                    
-            output_path = os.path.dirname(os.environ.get("CETK_DATABASE_PATH"))
-            stdout_files = glob.glob(os.path.join(gettempdir(), 'cetk_import_*_stdout.log'))
-            stderr_files = glob.glob(os.path.join(gettempdir(), 'cetk_import_*_stderr.log'))
-            
-            # Read the latest stderr file
-            stderr_files.sort(key=lambda f: int(f.split('_')[-2]))
-            if stderr_files:
-                latest_stderr_file = stderr_files[-1]
-                with open(latest_stderr_file, 'r') as f:
-                    self.stderr_content = f.read()
-            else:
-                self.stderr_content = None
-
-            validation_msgs = []
-            updates = []
-
-            def handle_line(l):
-                error = False
-                if l.startswith("VALIDATION"):
-                    validation_msgs.append(l.split("VALIDATION:")[1].strip())
-                elif l.startswith("ERROR"):
-                    validation_msgs.append(l)
-                else:
-                    error = True
-                    QgsMessageLog.logMessage(l, level=Qgis.Info)
-                return error
-            
-            error = False
-            # from qgis.PyQt.QtCore import pyqtRemoveInputHook;pyqtRemoveInputHook();breakpoint()
-            if  'successfully' in self.stderr_content:
-                if self.dry_run:
-                    changes = eval(self.stderr_content.split('\n')[-2].split("validated")[1].strip())
-                else:
-                    changes = eval(self.stderr_content.split('\n')[-2].split("imported")[1].strip())
-            elif 'Traceback' in self.stderr_content:
-                traceback = self.stderr_content
-                error = True
-            else:
-                for l in self.stderr_content.split('\n'):
-                    error = handle_line(l)
-                if error:
-                    traceback = self.stderr_content
 
+            validation_msgs = self.validation_msgs
+            changes = self.changes
+            error = self.traceback is not None
+            if error:
+                traceback = self.traceback
+                QgsMessageLog.logMessage(traceback, MESSAGE_CATEGORY, Qgis.Info)
 
             if self.backup_path is not None:
-                self.backup_path.unlink()
+                shutil.rmtree(self.backup_path.parent, ignore_errors=True)
 
             if self.dry_run:
                 if error:
-                    # from qgis.PyQt.QtCore import pyqtRemoveInputHook;pyqtRemoveInputHook();breakpoint()
                     tableDialog = TableDialog(
                         self,'Validation status',
                         "Did not validate full file. \n "
@@ -1203,15 +2265,13 @@ class RunImportTask(QgsTask):
                         "Try to correct spreadsheet using error information below: \n ",
                         os.linesep.join(traceback.split('\n'))
                     )
-                elif len(validation_msgs) > 0:
-                    # len_errors = len(validation_msgs) - 1 
-                    tableDialog = TableDialog(
-                        self,'Validation status',
-                        "Validated file successfully. \n "
-                        "Found errors, correct spreadsheet using error information "
-                        "given below before importing data: \n",
-                        os.linesep.join(validation_msgs)
+                elif self.nr_validation_msgs > 0:
+                    self.validation_report.set_status(
+                        f"Validated file successfully. \n"
+                        f"Found {self.nr_validation_msgs} errors, correct spreadsheet using error "
+                        "information given below before importing data."
                     )
+                    return
                 else:
                     tableDialog = TableDialog(
                         self,'Validation status',
@@ -1231,7 +2291,7 @@ class RunImportTask(QgsTask):
                         "given below untill reaching a successful validation before importing data: \n",
                         os.linesep.join(traceback.split('\n'))
                     )
-                if len(validation_msgs) > 0:
+                elif len(validation_msgs) > 0:
                     tableDialog = TableDialog(
                         self,'Import status',
                         "Did not import file successfully. \n "
@@ -1248,6 +2308,8 @@ class RunImportTask(QgsTask):
                     )
                 tableDialog.exec_()  
         else:
+            if self.backup_path is not None:
+                shutil.rmtree(self.backup_path.parent, ignore_errors=True)
             if self.exception is None:
                 QgsMessageLog.logMessage(
                     'Task "{name}" not successful but without '\
@@ -1258,9 +2320,11 @@ class RunImportTask(QgsTask):
             else:
                 if type(self.exception) == str:
                     error = self.exception
-                else:
+                elif isinstance(self.exception, CalledProcessError):
                     error = self.exception.stderr.decode("utf-8")
-                if "Database unspecified does not exist, first run 'cetk create' or 'cetk migrate'" in error:
+                else:
+                    error = str(self.exception)
+                if "unspecified does not exist, first run 'cetk create' or 'cetk migrate'" in error:
                     message_box('Error',f"Error: a target database is not specified yet,"
                     +" choose an existing or create a new database first.")
                 else:
@@ -1271,13 +2335,128 @@ class RunImportTask(QgsTask):
                         message_box('Import error',f"Error: {import_error}")
 
 
+    def finish_batch(self, result):
+        """Report the result of a file of a batch import to the batch."""
+        if self.backup_path is not None:
+            shutil.rmtree(self.backup_path.parent, ignore_errors=True)
+        changes = {}
+        if not result:
+            if self.exception is None:
+                status = "cancelled"
+            else:
+                status = f"error: {str(self.exception).split('ImportError:')[-1].strip()}"
+        elif self.traceback is not None:
+            QgsMessageLog.logMessage(self.traceback, MESSAGE_CATEGORY, Qgis.Info)
+            status = f"error: {self.traceback.strip().splitlines()[-1]}"
+        elif self.nr_validation_msgs > 0:
+            status = f"{self.nr_validation_msgs} validation errors"
+            if self.dry_run:
+                self.validation_report.set_status(
+                    f"Validated file successfully. \n"
+                    f"Found {self.nr_validation_msgs} errors, correct spreadsheet using error "
+                    "information given below before importing data."
+                )
+        else:
+            status = "validated" if self.dry_run else "imported"
+            changes = self.changes
+        self.batch.add_result(self.file_path, status, changes)
+
     def cancel(self):
         QgsMessageLog.logMessage(
             f"Task {self.description()} was canceled",
             MESSAGE_CATEGORY, Qgis.Info)
         super().cancel()
+        # stop cetk right away, the task waits until it has exited
+        if self.proc is not None:
+            signal_cetk(self.proc)
+
+
+class BatchImport:
+    """Imports (or validates) several files, the results are shown in one
+    report when all files are done.
+
+    Files validated on a copy of the database are validated in parallel. The
+    other files use the database itself and run one after another: a task is
+    only added when the task of the previous file has finished, as tasks
+    queue for the database in the order their threads start.
+    """
+
+    def __init__(self, dry_run, file_paths):
+        self.dry_run = dry_run
+        self.file_paths = file_paths
+        self.results = {}
+        self.tasks = []
+        self.current = None
+
+    def start(self, tasks):
+        self.tasks = []
+        for task in tasks:
+            if task.on_copy:
+                QgsApplication.taskManager().addTask(task)
+            else:
+                self.tasks.append(task)
+        self.start_next()
+
+    def start_next(self):
+        self.current = None
+        if self.tasks:
+            task = self.tasks.pop(0)
+            self.current = task.file_path
+            QgsApplication.taskManager().addTask(task)
+
+    def add_result(self, file_path, status, changes):
+        self.results[file_path] = (status, changes)
+        if len(self.results) == len(self.file_paths):
+            BatchReportDialog(self).exec_()
+        elif file_path == self.current:
+            self.start_next()
 
 
+class BatchReportDialog(QDialog):
+    """Created and updated counts per file of a batch import."""
+
+    def __init__(self, batch):
+        super().__init__()
+        self.batch = batch
+        self.initUI()
+
+    def initUI(self):
+        if self.batch.dry_run:
+            self.setWindowTitle("Validation status")
+            text = (
+                "Validated files. No changes to database yet, but number of features to be "
+                "created or updated if files would be imported are summarized per file."
+            )
+            columns = ["file", "status", "feature", "to be created", "to be updated"]
+        else:
+            self.setWindowTitle("Import status")
+            text = "Imported files. Number of features created or updated summarized per file."
+            columns = ["file", "status", "feature", "created", "updated"]
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel(text))
+
+        rows = []
+        for file_path in self.batch.file_paths:
+            status, changes = self.batch.results[file_path]
+            # timevars are not counted as created or updated, see TableDialog
+            features = sorted(key for key in changes if key != 'timevar')
+            if not features:
+                rows.append((Path(file_path).name, status, "", "", ""))
+            for feature in features:
+                rows.append((
+                    Path(file_path).name, status, feature,
+                    str(changes[feature]['created']), str(changes[feature]['updated'])
+                ))
+        tableWidget = QTableWidget(len(rows), len(columns), self)
+        tableWidget.setHorizontalHeaderLabels(columns)
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                tableWidget.setItem(row, column, QTableWidgetItem(value))
+        tableWidget.resizeColumnsToContents()
+        tableWidget.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(tableWidget)
+        self.setLayout(layout)
+        self.resize(800, 400)
 
 
 class RunBackgroundTask(QgsTask):
@@ -1287,13 +2466,30 @@ class RunBackgroundTask(QgsTask):
         self.parent = parent
         self.args = args
         self.kwargs = kwargs
+        self.timeout = get_task_timeout()
         self.exception = None
         self.proc = None
-
-    def check_process_ready(self):
-        if self.proc:
-            return self.proc.poll() is not None
-        return False
+        self.results = []
+        self.errors = []
+        self.nr_done = 0
+        self.database_jobs = get_database_jobs(kwargs.get("db_path"))
+
+    def handle_events(self, events):
+        """Collect results and errors of cetk_runner.py jobs."""
+        for event in events:
+            if event["event"] == "result":
+                self.results.append(event)
+            elif event["event"] == "error":
+                self.errors.append(event["message"])
+            elif event["event"] == "done":
+                self.nr_done += 1
+                self.set_job_progress(0)
+
+    def set_job_progress(self, value):
+        """Set the progress of the task from the percentage done of the
+        current job, jobs run one after the other."""
+        nr_jobs = max(self.proc.nr_jobs, 1)
+        self.setProgress(min(100 * (self.nr_done + value / 100) / nr_jobs, 100))
 
     def run(self):
         """Implement heavy lifting.
@@ -1301,22 +2497,27 @@ class RunBackgroundTask(QgsTask):
         Raising exceptions here will crash QGIS, raise them in self.finished instead.
         """
         QgsMessageLog.logMessage(f"Started task {self.description()}", MESSAGE_CATEGORY, Qgis.Info)
+        write_group = WRITING_JOBS.get(self.function)
+        with self.database_jobs.access(self, write=write_group is not None, group=write_group) as started:
+            if not started:
+                return False
+            return self.run_function()
+
+    def run_function(self):
         try:
             self.proc = self.function(*self.args, **self.kwargs)
-            for i in range(3600):
-                # Check if the process is ready
-                if self.check_process_ready(): 
-                    return True
-                else:
-                    if self.isCanceled():
-                        self.cancel()
-                        return False
-                    time.sleep(1)
-                    if i < 51:
-                        self.setProgress(i)
-                    else:
-                        self.setProgress(50+i/1150.*50.)
-            self.exception = f"Failed to complete {self.description()} within one hour."
+            if not wait_for_cetk(
+                self, self.proc, self.timeout, self.handle_events, self.set_job_progress
+            ):
+                self.cancel()
+                return False
+            if self.errors:
+                self.exception = os.linesep.join(self.errors)
+                return False
+            if self.proc.returncode != 0:
+                with open(self.proc.stderr_path, 'r') as f:
+                    self.exception = f.read() or f"cetk exited with status {self.proc.returncode}"
+                return False
         except Exception as e:
             self.exception =  e
             return False
@@ -1327,15 +2528,24 @@ class RunBackgroundTask(QgsTask):
         This function is automatically called when the task has
         completed (successfully or not). Result is the return value from self.run
         """
+        if "Rasterize emissions" in self.description() and self.parent.load_canvas:
+            # also load the rasters of completed jobs when other jobs failed
+            for job_result in self.results:
+                load_rasters_to_canvas(job_result["outputpath"], job_result["nonzero"])
         if result:
             QgsMessageLog.logMessage(
                 f"Task {self.description()} completed",
                 MESSAGE_CATEGORY, Qgis.Success)
-            if "Rasterize emissions" in self.description():
-                if self.parent.load_canvas:
-                    load_rasters_to_canvas(self.kwargs["outputpath"], self.parent.time_threshold)
-            elif self.description() == "Prepare emissions for static visualisation":
-                self.parent.load_join()
+            if self.description() == "Prepare emissions for static visualisation":
+                for job_result in self.results:
+                    for sourcetype, nr_sources in job_result["updated"].items():
+                        if nr_sources is None:
+                            message = f"Re-created emission table of {sourcetype} sources"
+                        else:
+                            message = f"Recomputed emissions of {nr_sources} changed {sourcetype} sources"
+                        QgsMessageLog.logMessage(message, MESSAGE_CATEGORY, Qgis.Info)
+                    for sourcetype, view in job_result["views"].items():
+                        self.parent.load_join(sourcetype, view)
         else:
             if self.exception is None:
                 QgsMessageLog.logMessage(
@@ -1355,3 +2565,32 @@ class RunBackgroundTask(QgsTask):
             f"Task {self.description()} was canceled",
             MESSAGE_CATEGORY, Qgis.Info)
         super().cancel()
+        # stop cetk right away, the task waits until it has exited
+        if self.proc is not None:
+            signal_cetk(self.proc)
+
+
+class JobResultTask(RunBackgroundTask):
+    """Runs a cetk_runner.py job reading the database, its result event is
+    passed to on_result on the main thread of QGIS."""
+
+    def __init__(self, description, parent, on_result, job, **kwargs):
+        super().__init__(description, run_cetk_job, parent, job, **kwargs)
+        self.on_result = on_result
+
+    def finished(self, result):
+        if result and self.results:
+            self.on_result(self.results[-1])
+        super().finished(result)
+
+
+class TaskGroup(QgsTask):
+    """Runs tasks in parallel as sub-tasks, showing their combined progress."""
+
+    def __init__(self, description, tasks):
+        super().__init__(description, QgsTask.CanCancel)
+        for task in tasks:
+            self.addSubTask(task)
+
+    def run(self):
+        return True
@@ -0,0 +1,47 @@
+"""
+Definitions shared by the Eclair plugin and cetk_runner.py.
+
+This module must not import cetk, QGIS or Qt: the plugin cannot import cetk,
+and cetk_runner.py runs in the python interpreter of cetk, without QGIS.
+"""
+
+import os
+import re
+
+# progress as reported in cetk debug messages, e.g. "done 42%"
+PROGRESS_PATTERN = re.compile(r"done (\d+(?:\.\d+)?)%")
+# output formats of rasters, by the extension of their files
+RASTER_FORMATS = {
+    "netcdf": ".nc",
+    "geotiff": ".tif",
+    "zarr": ".zarr",
+    "coo": ".csv.gz",
+}
+# existing rasters of substances raise an error, are overwritten or are kept
+OVERWRITE_POLICIES = ("error", "overwrite", "keep")
+# sheets can also be imported from a directory with one of these files per sheet
+TABLE_EXTENSIONS = (".parquet", ".csv")
+
+
+def table_row_count(path):
+    """Return the number of rows below the header of a CSV or Parquet file,
+    None if pyarrow is not installed to read a Parquet file.
+
+    Lines of a CSV file are counted, quoted values with line breaks are rare in
+    source sheets.
+    """
+    path = os.fspath(path)
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            return None
+        return pq.ParquetFile(path).metadata.num_rows
+    if os.path.getsize(path) == 0:
+        return 0
+    with open(path, "rb") as f:
+        nr_lines = sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            nr_lines += 1
+    return max(nr_lines - 1, 0)
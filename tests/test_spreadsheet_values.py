@@ -0,0 +1,22 @@
+"""Tests of reading CSV files as spreadsheets, see cetk_runner.py."""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("cetk")
+pd = pytest.importorskip("pandas")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import cetk_runner  # noqa: E402
+
+
+def test_spreadsheet_values():
+    column = pd.Series(
+        ["007", "01", "0", "-3", "1.5", "2e3", "abc", None, "+1"], dtype=object
+    )
+    values = cetk_runner.spreadsheet_values(column).tolist()
+    assert values == ["007", "01", 0, -3, 1.5, 2000.0, "abc", None, "+1"]
+    assert isinstance(values[2], int)
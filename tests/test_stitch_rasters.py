@@ -0,0 +1,126 @@
+"""Tests of stitching rasters of tiles and periods and of writing rasters, see
+cetk_runner.py."""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("cetk")
+nc = pytest.importorskip("netCDF4")
+np = pytest.importorskip("numpy")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import cetk_runner  # noqa: E402
+
+
+def write_part(path, nx, ny, values, first_hour=0):
+    """Write a NetCDF file of a part with emissions values[time, y, x]."""
+    path.mkdir()
+    hours = first_hour + np.arange(len(values))
+    with nc.Dataset(path / "nox.nc", "w", format="NETCDF4") as dset:
+        dset.createDimension("time", None)
+        dset.createDimension("bounds_dim", 2)
+        dset.createDimension("y", ny)
+        dset.createDimension("x", nx)
+        time = dset.createVariable("time", "f8", ("time",))
+        time.bounds = "time_bounds"
+        time[:] = hours
+        bounds = dset.createVariable("time_bounds", "f8", ("time", "bounds_dim"))
+        bounds[:] = np.column_stack([hours - 1, hours])
+        dset.createVariable("x", "f8", ("x",))
+        dset.createVariable("y", "f8", ("y",))
+        var = dset.createVariable(
+            "emission_nox", "f4", ("time", "y", "x"), fill_value=-9999.0
+        )
+        var[:] = values
+    return path
+
+
+def read_emissions(path):
+    with nc.Dataset(path / "nox.nc") as dset:
+        return dset["emission_nox"][:], dset["x"][:], dset["y"][:]
+
+
+def test_stitch_tiles(tmp_path):
+    left = write_part(tmp_path / "left", 2, 2, np.full((1, 2, 2), 1.0))
+    # rounding the extent of a tile may add a cell, which is cropped
+    right = write_part(tmp_path / "right", 3, 2, np.full((1, 2, 3), 2.0))
+    output = tmp_path / "output"
+    output.mkdir()
+    cetk_runner.stitch_rasters(
+        str(output),
+        [((0, 0, 2, 2), 0, str(left)), ((2, 0, 2, 2), 0, str(right))],
+        (0, 0, 400, 200),
+        100,
+    )
+    emissions, x, y = read_emissions(output)
+    assert emissions.shape == (1, 2, 4)
+    np.testing.assert_array_equal(emissions[0], [[1, 1, 2, 2], [1, 1, 2, 2]])
+    np.testing.assert_array_equal(x, [50, 150, 250, 350])
+    np.testing.assert_array_equal(y, [50, 150])
+
+
+def test_stitch_overlays(tmp_path):
+    left = write_part(tmp_path / "left", 2, 1, np.full((1, 1, 2), 1.0))
+    right = write_part(tmp_path / "right", 2, 1, np.full((1, 1, 2), 2.0))
+    # area sources crossing the tiles, rasterized on the two middle cells
+    overlay = write_part(tmp_path / "overlay", 2, 1, np.full((1, 1, 2), 10.0))
+    output = tmp_path / "output"
+    output.mkdir()
+    cetk_runner.stitch_rasters(
+        str(output),
+        [((0, 0, 2, 1), 0, str(left)), ((2, 0, 2, 1), 0, str(right))],
+        (0, 0, 4, 1),
+        1,
+        overlays=[((1, 0, 2, 1), 0, str(overlay))],
+    )
+    emissions, _, _ = read_emissions(output)
+    np.testing.assert_array_equal(emissions[0], [[1, 11, 12, 2]])
+
+
+def test_stitch_periods(tmp_path):
+    values = np.ma.masked_array(
+        np.ones((3, 1, 1)), mask=[[[True]], [[False]], [[False]]]
+    )
+    # the first hour of the first period is masked, its last hour is missing
+    first = write_part(tmp_path / "first", 1, 1, values)
+    second = write_part(
+        tmp_path / "second", 1, 1, np.full((2, 1, 1), 2.0), first_hour=4
+    )
+    output = tmp_path / "output"
+    output.mkdir()
+    times = [100.0 + hour for hour in range(6)]
+    cetk_runner.stitch_rasters(
+        str(output),
+        [((0, 0, 1, 1), 0, str(first)), ((0, 0, 1, 1), 4, str(second))],
+        (0, 0, 1, 1),
+        1,
+        times=times,
+    )
+    emissions, _, _ = read_emissions(output)
+    np.testing.assert_array_equal(emissions[:, 0, 0], [0, 1, 1, 0, 2, 2])
+    with nc.Dataset(output / "nox.nc") as dset:
+        np.testing.assert_array_equal(dset["time"][:], times)
+        np.testing.assert_array_equal(
+            dset["time_bounds"][:], [[hour - 1, hour] for hour in times]
+        )
+
+
+def test_write_netcdf_chunks(tmp_path):
+    values = np.ma.masked_equal(np.arange(3 * 300 * 2, dtype="f4"), 0)
+    part = write_part(tmp_path / "part", 2, 300, values.reshape(3, 300, 2))
+    path = str(part / "nox.nc")
+    # rasters are rewritten in place
+    cetk_runner.write_netcdf(path, path, 100)
+    with nc.Dataset(path) as dset:
+        var = dset["emission_nox"]
+        assert var.chunking() == [1, 256, 2]
+        assert var.filters()["zlib"]
+        assert dset["time"].bounds == "time_bounds"
+        np.testing.assert_array_equal(dset["time_bounds"][:, 1], [0, 1, 2])
+        emissions = var[:]
+    assert emissions.mask[0, 0, 0]
+    np.testing.assert_array_equal(emissions, values.reshape(3, 300, 2))
+    assert sorted(p.name for p in part.iterdir()) == ["nox.nc"]